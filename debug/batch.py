@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+"""Run gdbserver.py tests against several targets in a single process, and
+report all the results together. Compiled programs are shared between targets
+where they'd be identical, and each target is only examined once."""
+
+import argparse
+import copy
+import sys
+import time
+
+import gdbserver
+import targets
+import testlib
+
+def parse_target(text):
+    """Parse TARGET[:TEST,...] into a path and a list of test filters."""
+    path, _, tests = text.partition(":")
+    return path, [test for test in tests.split(",") if test]
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+            description="Run tests against several targets in one go.",
+            epilog="""
+            Example:
+            ./batch.py --sim_cmd $RISCV/bin/spike targets/RISC-V/spike32.py
+            targets/RISC-V/spike64.py targets/RISC-V/spike-multi.py:Multi
+            """)
+    parser.add_argument("targets", nargs="+", type=parse_target,
+            metavar="TARGET[:TEST,...]",
+            help=".py file that contains the definition for a target to test "
+            "with, optionally followed by the tests to run on just that "
+            "target.")
+    parser.add_argument("--test", "-t", action="append",
+            help="Run only tests whose name contains TEST, on targets that "
+            "don't list their own tests. May be given more than once.")
+    targets.add_target_options(parser, positional=False)
+    testlib.add_test_run_options(parser, positional=False)
+    return parser.parse_intermixed_args()
+
+def add_report(name, report, results, runs):
+    """Add the results in report, of the target called name, to results and
+    runs. Return whether any test failed."""
+    runs += [(f"{name}/{test}", result, elapsed)
+            for test, result, elapsed in report.runs]
+    failed = False
+    for result, entries in report.results.items():
+        for test, log_name in entries:
+            results.setdefault(result, []).append(
+                    (f"{name}/{test}", log_name))
+        failed |= result not in testlib.good_results
+    return failed
+
+def run_targets(parsed):
+    """Run the tests on every target. Return how many ran, the results (like
+    Report.results) and the runs (like Report.runs), with test names prefixed
+    by the name of the target."""
+    results = {}
+    runs = []
+    count = 0
+    # A target listed more than once is only instantiated, and examined, once.
+    instances = {}
+    for path, tests in parsed.targets:
+        target_parsed = copy.copy(parsed)
+        target_parsed.target = path
+        target_parsed.test = tests or parsed.test
+        if parsed.time_budget is not None:
+            # The budget is for the whole run, not for each target.
+            target_parsed.time_budget = parsed.time_budget / len(parsed.targets)
+        if path not in instances:
+            instances[path] = targets.target(target_parsed)
+        target = instances[path]
+        name = type(target).__name__
+
+        todo, _ = testlib.select_tests(gdbserver, target, target_parsed)
+        if parsed.list_tests:
+            for test, _, _ in todo:
+                print(f"{path} {test}")
+            continue
+
+        testlib.header(f"{name}: {len(todo)} tests", dash='=')
+        report = testlib.run_target(target_parsed, target, todo)
+        count += report.count
+        if add_report(name, report, results, runs) and parsed.fail_fast:
+            break
+    return count, results, runs
+
+def main():
+    parsed = parse_args()
+
+    overall_start = time.time()
+    count, results, runs = run_targets(parsed)
+
+    if parsed.list_tests:
+        return 0
+
+    testlib.header(f"ran {count} tests on {len(parsed.targets)} targets in "
+            f"{time.time() - overall_start:.0f}s", dash=':')
+
+    if parsed.results:
+        testlib.write_results(parsed.results, ",".join(
+            path for path, _ in parsed.targets), results)
+
+    if parsed.repeat > 1:
+        testlib.print_repeat_summary(runs)
+
+    return testlib.print_results(results)
+
+if __name__ == '__main__':
+    sys.exit(main())
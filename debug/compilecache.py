@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+"""Content-addressed store of compiled test programs, shared by every run (and
+every worker process) on a machine, so that a program is only compiled again
+when something that goes into it changes.
+
+A program is found by a hash of the compiler's `--version`, the arguments it
+was compiled with, and the contents of every source, header (found by
+following #include "..." and .incbin "...") and link script that went into
+it. Include directories only count through what's found in them, so the same
+program built from a different directory has the same key. Libraries that
+ar makes of compiled objects are stored the same way. Least recently used
+programs are thrown away when the store gets too big.
+
+    ./compilecache.py stats
+    ./compilecache.py export programs.tar.gz
+    ./compilecache.py import programs.tar.gz
+    ./compilecache.py clear
+
+A store exported on a machine with a toolchain can be imported on one without,
+which can then run tests as long as they don't need anything new compiled."""
+
+import argparse
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+# What C and assembly sources pull in from other files.
+INCLUDE = re.compile(rb'^\s*(?:#\s*include|\.incbin)\s*"([^"]+)"',
+        re.MULTILINE)
+
+# Contents hashes of files, by (path, mtime, size), so that each file is only
+# read once per process.
+hashes = {}
+
+def default_path():
+    base = os.environ.get("XDG_CACHE_HOME") or \
+            os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "riscv-tests-debug", "programs")
+
+def hash_file(path):
+    status = os.stat(path)
+    key = (os.path.realpath(path), status.st_mtime_ns, status.st_size)
+    if key not in hashes:
+        digest = hashlib.sha256()
+        with open(path, "rb") as fd:
+            for block in iter(lambda: fd.read(1 << 20), b""):
+                digest.update(block)
+        hashes[key] = digest.hexdigest()
+    return hashes[key]
+
+def includes(path, include_dirs, found):
+    """Add the files path #includes (recursively) to found. Headers that
+    aren't found, like the C library's, are part of the compiler."""
+    try:
+        with open(path, "rb") as fd:
+            names = INCLUDE.findall(fd.read())
+    except OSError:
+        return
+    for name in names:
+        for directory in [os.path.dirname(path)] + include_dirs:
+            candidate = os.path.normpath(os.path.join(directory,
+                name.decode(errors="replace")))
+            if os.path.isfile(candidate):
+                if candidate not in found:
+                    found.add(candidate)
+                    includes(candidate, include_dirs, found)
+                break
+
+class Cache:
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.versions = {}
+
+    def entry(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def compiler_version(self, gcc):
+        """Return what gcc --version prints, or what it printed when this
+        store (or the one it was imported from) last saw it, if gcc can't be
+        run here."""
+        if gcc not in self.versions:
+            saved = os.path.join(self.path, "compilers",
+                    os.path.basename(gcc))
+            try:
+                version = subprocess.check_output([gcc, "--version"],
+                        stderr=subprocess.DEVNULL).decode(errors="replace")
+                os.makedirs(os.path.dirname(saved), exist_ok=True)
+                with open(saved, "w", encoding="utf-8") as fd:
+                    fd.write(version)
+            except (OSError, subprocess.CalledProcessError):
+                try:
+                    with open(saved, encoding="utf-8") as fd:
+                        version = fd.read()
+                except OSError:
+                    version = None
+            self.versions[gcc] = version
+        return self.versions[gcc]
+
+    def key(self, gcc, args):
+        """Return the key of the program gcc builds from args, or None if it
+        can't be known."""
+        version = self.compiler_version(gcc)
+        if version is None:
+            return None
+        digest = hashlib.sha256(version.encode())
+        include_dirs = []
+        for i, arg in enumerate(args):
+            if arg == "-I" and i + 1 < len(args):
+                include_dirs.append(args[i + 1])
+            elif arg.startswith("-I") and len(arg) > 2:
+                include_dirs.append(arg[2:])
+        found = set()
+        skip = False
+        for arg in args:
+            if skip:
+                # The output file doesn't change what's built, and include
+                # directories only through the files found in them.
+                skip = False
+                continue
+            if arg in ("-o", "-I"):
+                skip = True
+            elif arg.startswith("-I"):
+                arg = "-I"
+            elif os.path.isfile(arg):
+                digest.update(f"file {hash_file(arg)}\n".encode())
+                includes(arg, include_dirs, found)
+                continue
+            digest.update(f"arg {arg}\n".encode())
+        for line in sorted(
+                f"include {os.path.basename(path)} {hash_file(path)}\n"
+                for path in found):
+            digest.update(line.encode())
+        return digest.hexdigest()
+
+    def get(self, key, output):
+        """Put the program with key at output, and return True, if it's in
+        the store."""
+        entry = self.entry(key)
+        try:
+            # Mark it as recently used.
+            os.utime(entry)
+        except OSError:
+            return False
+        if os.path.lexists(output):
+            os.unlink(output)
+        try:
+            os.link(entry, output)
+        except OSError:
+            # Eg. on a different file system.
+            shutil.copyfile(entry, output)
+            shutil.copymode(entry, output)
+        return True
+
+    def put(self, key, output):
+        entry = self.entry(key)
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            fd, temporary = tempfile.mkstemp(dir=os.path.dirname(entry))
+            os.close(fd)
+            shutil.copyfile(output, temporary)
+            shutil.copymode(output, temporary)
+            os.replace(temporary, entry)
+        except OSError:
+            # The store is an optimization; failing to add to it is fine.
+            return
+        self.evict()
+
+    def entries(self):
+        """Return (mtime, size, path) of everything in the store."""
+        result = []
+        for directory, _, names in os.walk(self.path):
+            if os.path.basename(directory) == "compilers":
+                continue
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    status = os.stat(path)
+                except OSError:
+                    continue
+                result.append((status.st_mtime, status.st_size, path))
+        return result
+
+    def evict(self):
+        """Remove least recently used programs until the store fits in
+        max_size bytes."""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        while entries and total > self.max_size:
+            _, size, path = entries.pop(0)
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+    def export(self, path):
+        with tarfile.open(path, "w:gz") as tar:
+            tar.add(self.path, arcname=".")
+
+    def import_(self, path):
+        with tarfile.open(path, "r:gz") as tar:
+            members = [m for m in tar.getmembers()
+                    if (m.isfile() or m.isdir()) and not m.name.startswith("/")
+                    and ".." not in m.name.split("/")]
+            tar.extractall(self.path, members)
+        self.evict()
+
+def open_cache(parsed):
+    """Return the Cache selected by --compile-cache, or None."""
+    if parsed.compile_cache == "none":
+        return None
+    return Cache(parsed.compile_cache or default_path(),
+            parsed.compile_cache_size * 1024 * 1024)
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Manage the store of compiled test programs.")
+    parser.add_argument("--compile-cache", default=default_path(),
+            help="Store to use. Defaults to %(default)s.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats", help="Show how much is stored.")
+    subparsers.add_parser("clear", help="Remove everything.")
+    export = subparsers.add_parser("export",
+            help="Write the whole store to a .tar.gz file.")
+    export.add_argument("file")
+    import_ = subparsers.add_parser("import",
+            help="Add the programs in a .tar.gz file written by export.")
+    import_.add_argument("file")
+    import_.add_argument("--size", type=int, default=1024,
+            help="Keep the store under this many MB. Defaults to "
+            "%(default)s.")
+    parsed = parser.parse_args()
+
+    cache = Cache(parsed.compile_cache,
+            getattr(parsed, "size", 1024) * 1024 * 1024)
+    if parsed.command == "stats":
+        entries = cache.entries()
+        megabytes = sum(size for _, size, _ in entries) / 1024 / 1024
+        print(f"{cache.path}: {len(entries)} programs, {megabytes:.1f} MB")
+    elif parsed.command == "clear":
+        shutil.rmtree(cache.path, ignore_errors=True)
+    elif parsed.command == "export":
+        cache.export(parsed.file)
+    else:
+        cache.import_(parsed.file)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+"""Keep the test harness running between invocations, so that running a test
+again doesn't have to start Python, import and examine the target, and compile
+programs all over again.
+
+    ./daemon.py serve &
+    ./daemon.py run targets/RISC-V/spike64.py MemTest8 --print-failures
+
+run takes the same arguments as gdbserver.py, and prints the same output.
+Targets stay instantiated (and examined) for as long as the daemon runs, and
+compiled programs are kept until something in programs/ or the target's link
+scripts changes. gdbserver.py (or whatever file the tests come from) is
+reloaded when it changes.
+
+Tests share stacks as with --share-stacks, and the daemon keeps the stack each
+test leaves behind, by its stack_key(), so that running a test again doesn't
+have to start the simulator, server and gdb either. Tests run in the daemon
+itself; add --fork to run each one in a process of its own instead, so that a
+test that crashes or hangs doesn't take the daemon down."""
+
+import argparse
+import glob
+import multiprocessing
+import os
+import socket
+import socketserver
+import sys
+import tempfile
+
+import compilecache
+import harness
+import targets
+import testlib
+
+def default_socket():
+    return os.path.join(tempfile.gettempdir(),
+            f"riscv-tests-debug-{os.getuid()}.sock")
+
+def run_parser():
+    parser = argparse.ArgumentParser(prog="daemon.py run")
+    targets.add_target_options(parser)
+    testlib.add_test_run_options(parser)
+    return parser
+
+class ClientOutput:
+    """Stands in for sys.stdout while a request runs, and sends everything
+    written to it to the client. With --jobs, the worker processes inherit it,
+    so every message is sent under a lock that they share, which keeps
+    messages from different processes from being interleaved."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = multiprocessing.get_context("fork").Lock()
+
+    def write(self, text):
+        try:
+            with self.lock:
+                harness.send_message(self.sock, {"output": text})
+        except OSError:
+            # The client went away. Keep going, so that the run still ends
+            # up in the logs and the history database.
+            pass
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def fileno(self):
+        return self.sock.fileno()
+
+class WarmSession(testlib.Session):
+    """A session that keeps every stack that tests leave behind, by its
+    stack_key(), rather than only the last one, so that whichever test runs
+    next can find its stack still up."""
+    def __init__(self, target, **kwargs):
+        self.target = target
+        self.stacks = {}
+        self.last = None
+        super().__init__(**kwargs)
+        self.keep_stack = True
+
+    @property
+    def stack(self):
+        """The stack the last test left behind."""
+        return self.last
+
+    @stack.setter
+    def stack(self, stack):
+        self.last = stack
+        if stack is not None:
+            self.stacks[stack.key] = stack
+
+    def take_stack(self, key=None):
+        stack = self.stacks.pop(key, None)
+        if stack is self.last:
+            self.last = None
+        return stack
+
+    def drop_stack(self):
+        self.stacks.clear()
+        self.last = None
+
+class State:
+    """Everything the daemon keeps between requests."""
+    def __init__(self):
+        self.targets = {}
+        self.modules = {}
+        self.sessions = {}
+        self.inputs = None
+
+    def target(self, parsed):
+        """Return the target for parsed, reusing it (and whatever
+        ExamineTarget found out about it) if the target file hasn't
+        changed."""
+        key = (parsed.target, os.path.getmtime(parsed.target),
+                parsed.sim_cmd, parsed.server_cmd, parsed.xlen, parsed.isolate)
+        if key not in self.targets:
+            # Make targets.target() import the file again.
+            module_name = os.path.splitext(os.path.basename(parsed.target))[0]
+            sys.modules.pop(module_name, None)
+            self.targets[key] = targets.target(parsed)
+            # Shut down the stacks of the old version of the file.
+            for old in [k for k in self.targets if k[0] == key[0] and k != key]:
+                for warm in self.sessions.values():
+                    if warm.target is self.targets[old]:
+                        warm.drop_stack()
+        return self.targets[key]
+
+    def session(self, parsed, target):
+        """Return the WarmSession that tests on target run in, with the rest
+        of its settings taken from parsed."""
+        key = (id(target), parsed.gdb)
+        if key not in self.sessions:
+            self.sessions[key] = WarmSession(target, gdb_cmd=parsed.gdb)
+        warm = self.sessions[key]
+        warm.gcc_cmd = parsed.gcc
+        warm.print_log_names = parsed.print_log_names
+        warm.compile_cache = compilecache.open_cache(parsed)
+        return warm
+
+    def module(self, path):
+        """Return the tests module in path, loading it again if it
+        changed."""
+        mtime = os.path.getmtime(path)
+        if path not in self.modules or self.modules[path][0] != mtime:
+            self.modules[path] = (mtime, testlib.load_module(path))
+        return self.modules[path][1]
+
+    def forget_stale_programs(self, target):
+        """Throw away compiled programs if any of their sources changed."""
+        directory = os.path.dirname(os.path.abspath(__file__))
+        paths = glob.glob(os.path.join(directory, "programs", "*")) + \
+                glob.glob(os.path.join(directory, "..", "env", "*")) + \
+                [hart.link_script_path for hart in target.harts]
+        inputs = sorted((path, os.path.getmtime(path)) for path in paths
+                if os.path.exists(path))
+        if inputs != self.inputs:
+            testlib.BaseTest.compiled.clear()
+            targets.Target.runtimes.clear()
+            # Reusing a stack doesn't load the programs again.
+            for warm in self.sessions.values():
+                warm.drop_stack()
+            self.inputs = inputs
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = harness.receive_message(self.rfile)
+        output = ClientOutput(self.request)
+        saved_stdout = sys.stdout
+        sys.stdout = output
+        try:
+            code = self.run(request)
+        except SystemExit as e:
+            # argparse exits on bad arguments, after printing why.
+            code = e.code
+        except Exception as e:    # pylint: disable=broad-except
+            print(f"daemon: {type(e).__name__}: {e}")
+            code = 1
+        finally:
+            sys.stdout = saved_stdout
+        try:
+            harness.send_message(self.request, {"exit": code})
+        except OSError:
+            pass
+
+    def run(self, request):
+        parser = run_parser()
+        saved_stderr = sys.stderr
+        sys.stderr = sys.stdout
+        try:
+            parsed = parser.parse_args(request["argv"])
+        finally:
+            sys.stderr = saved_stderr
+        # Paths on the command line are relative to the client.
+        parsed.target = os.path.join(request["cwd"], parsed.target)
+        parsed.logs = os.path.join(request["cwd"], parsed.logs)
+        for option in ("history", "results", "jsonl", "junit",
+                "shard_timings"):
+            if getattr(parsed, option) not in (None, "none"):
+                setattr(parsed, option, os.path.join(request["cwd"],
+                    getattr(parsed, option)))
+        # Keeping stacks between requests is what the daemon is for.
+        parsed.share_stacks = True
+        # The client can't interrupt the daemon to stop watching.
+        parsed.watch = False
+
+        state = self.server.state
+        target = state.target(parsed)
+        state.forget_stale_programs(target)
+        module = state.module(os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "gdbserver.py"))
+        return testlib.run_all_tests(module, target, parsed,
+                state.session(parsed, target))
+
+class Server(socketserver.UnixStreamServer):
+    def __init__(self, path):
+        socketserver.UnixStreamServer.__init__(self, path, Handler)
+        self.state = State()
+
+def serve(parsed):
+    if os.path.exists(parsed.socket):
+        os.unlink(parsed.socket)
+    # Programs and targets are found relative to the harness directory.
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    server = Server(parsed.socket)
+    print(f"Listening on {parsed.socket}")
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.unlink(parsed.socket)
+    return 0
+
+def run(parsed):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(parsed.socket)
+    except OSError as e:
+        print(f"Couldn't connect to {parsed.socket} ({e}). Start the daemon "
+                "with './daemon.py serve'.")
+        return 1
+    harness.send_message(sock, {"argv": parsed.args, "cwd": os.getcwd()})
+    reader = sock.makefile("rb")
+    while True:
+        try:
+            message = harness.receive_message(reader)
+        except EOFError:
+            print("The daemon went away.")
+            return 1
+        if "exit" in message:
+            return message["exit"]
+        sys.stdout.write(message["output"])
+        sys.stdout.flush()
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Keep the harness running between test runs.")
+    parser.add_argument("--socket", default=default_socket(),
+            help="Unix socket the daemon listens on.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("serve", help="Run the daemon.")
+    run_command = subparsers.add_parser("run",
+            help="Have the daemon run tests. Takes the same arguments as "
+            "gdbserver.py.")
+    run_command.add_argument("args", nargs=argparse.REMAINDER)
+    parsed = parser.parse_args()
+
+    if parsed.command == "serve":
+        return serve(parsed)
+    return run(parsed)
+
+if __name__ == '__main__':
+    sys.exit(main())
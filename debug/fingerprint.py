@@ -0,0 +1,116 @@
+"""Hash everything that can affect the outcome of a test: its source, the
+programs it compiles, the target definition, and the tools it runs. A test
+whose fingerprint hasn't changed since it last passed is expected to pass
+again."""
+
+import glob
+import hashlib
+import inspect
+import os
+import shlex
+import shutil
+
+import harness
+
+# Sources that are linked into every program, or that spike runs while it
+# waits for the debugger.
+RUNTIME_SOURCES = ("programs/entry.S", "programs/init.c", "programs/checksum.c",
+        "programs/tiny-malloc.c", "programs/infinite_loop.S")
+
+class Fingerprinter:
+    def __init__(self, parsed, target):
+        self.parsed = parsed
+        self.target = target
+        self.hashes = {}
+        self.common = None
+
+    def hash_file(self, path):
+        """Return a hash of the contents of path, or None if it doesn't
+        exist. Each file is only read once."""
+        path = os.path.realpath(path)
+        if path not in self.hashes:
+            digest = hashlib.sha256()
+            try:
+                with open(path, "rb") as fd:
+                    for block in iter(lambda: fd.read(1 << 20), b""):
+                        digest.update(block)
+                self.hashes[path] = digest.hexdigest()
+            except OSError:
+                self.hashes[path] = None
+        return self.hashes[path]
+
+    def tools(self):
+        """Return the commands used to build and run tests."""
+        return (self.parsed.gcc or "riscv64-unknown-elf-gcc",
+                self.parsed.gdb or "riscv64-unknown-elf-gdb",
+                self.target.server_cmd or "openocd",
+                self.target.sim_cmd or "spike")
+
+    def common_files(self):
+        """Return files that every test on this target depends on."""
+        directory = os.path.dirname(os.path.abspath(__file__))
+        files = [os.path.join(directory, "testlib.py"),
+                os.path.join(directory, "targets.py"),
+                self.target.path, self.target.openocd_config_path]
+        # What DownloadTest builds, besides its compile_args.
+        files += [os.path.join(directory, "payload.py"),
+                harness.find_file("programs/download.c")]
+        for path in RUNTIME_SOURCES:
+            files.append(harness.find_file(path))
+        files += glob.glob(os.path.join(directory, "programs", "*.h"))
+        for hart in self.target.harts:
+            files.append(hart.link_script_path)
+        for cls in type(self.target).__mro__ + sum(
+                (type(hart).__mro__ for hart in self.target.harts), ()):
+            try:
+                files.append(inspect.getsourcefile(cls))
+            except TypeError:
+                # Builtins like object.
+                pass
+        for command in self.tools():
+            for word in shlex.split(command):
+                found = shutil.which(word)
+                if found:
+                    files.append(found)
+        return sorted(set(f for f in files if f))
+
+    def test_files(self, definition):
+        """Return the files that only definition depends on."""
+        files = []
+        for arg in getattr(definition, 'compile_args', None) or ():
+            found = harness.find_file(arg)
+            if found and os.path.isfile(found):
+                files.append(found)
+        return files
+
+    def files(self, definition):
+        """Return every file definition depends on, including the one it is
+        defined in (fingerprint() only hashes the test's own source)."""
+        own = [definition.source_file] if definition.source_file else []
+        return self.common_files() + self.test_files(definition) + own
+
+    def fingerprint(self, definition):
+        if self.common is None:
+            digest = hashlib.sha256()
+            for path in self.common_files():
+                digest.update(f"{path} {self.hash_file(path)}\n".encode())
+            for command in self.tools():
+                digest.update(f"{command}\n".encode())
+            for hart in self.target.harts:
+                digest.update(f"{hart.name} {hart.xlen} {hart.misa}\n"
+                        .encode())
+            self.common = digest.hexdigest()
+
+        digest = hashlib.sha256(self.common.encode())
+        # The source of the test includes the setup and helpers it inherits
+        # from other tests in the same file.
+        for cls in definition.__mro__:
+            if cls.__dict__.get('variant_of'):
+                # Variants are made by BaseTest, and have no source.
+                digest.update(repr(sorted(cls.parameters.items())).encode())
+            elif cls.__module__ == definition.__module__:
+                digest.update(inspect.getsource(cls).encode())
+        digest.update(repr(getattr(definition, 'compile_args', None)).encode())
+        for path in self.test_files(definition):
+            digest.update(f"{path} {self.hash_file(path)}\n".encode())
+        return digest.hexdigest()
@@ -1,15 +1,14 @@
 #!/usr/bin/env python3
 
 import argparse
-import binascii
+import os
 import random
-import struct
 import sys
 import tempfile
 import time
-import os
 import re
 
+import payload
 import targets
 import testlib
 from testlib import assertEqual, assertNotEqual, assertIn, assertNotIn
@@ -113,21 +112,18 @@ class SimpleRegisterTest(GdbTest):
     def setup(self):
         self.write_nop_program(5)
 
-class SimpleS0Test(SimpleRegisterTest):
-    def test(self):
-        self.check_reg("s0", "x8")
-
-class SimpleS1Test(SimpleRegisterTest):
-    def test(self):
-        self.check_reg("s1", "x9")
-
-class SimpleT0Test(SimpleRegisterTest):
-    def test(self):
-        self.check_reg("t0", "x5")
+class SimpleAliasTest(SimpleRegisterTest):
+    register = None
+    alias = None
+    variants = {
+        "SimpleS0Test": {"register": "s0", "alias": "x8"},
+        "SimpleS1Test": {"register": "s1", "alias": "x9"},
+        "SimpleT0Test": {"register": "t0", "alias": "x5"},
+        "SimpleT1Test": {"register": "t1", "alias": "x6"},
+    }
 
-class SimpleT1Test(SimpleRegisterTest):
     def test(self):
-        self.check_reg("t1", "x6")
+        self.check_reg(self.register, self.alias)
 
 class SimpleV13Test(SimpleRegisterTest):
     def test(self):
@@ -239,21 +235,18 @@ class SimpleMemoryTest(GdbTest):
         assertEqual(self.gdb.p("*((%s*)0x%x)" % (data_type, addrA)), a)
         assertEqual(self.gdb.p("*((%s*)0x%x)" % (data_type, addrB)), b)
 
-class MemTest8(SimpleMemoryTest):
-    def test(self):
-        self.access_test(1, 'char')
-
-class MemTest16(SimpleMemoryTest):
-    def test(self):
-        self.access_test(2, 'short')
+class MemTest(SimpleMemoryTest):
+    size = None
+    data_type = None
+    variants = {
+        "MemTest8": {"size": 1, "data_type": "char"},
+        "MemTest16": {"size": 2, "data_type": "short"},
+        "MemTest32": {"size": 4, "data_type": "int"},
+        "MemTest64": {"size": 8, "data_type": "long long"},
+    }
 
-class MemTest32(SimpleMemoryTest):
     def test(self):
-        self.access_test(4, 'int')
-
-class MemTest64(SimpleMemoryTest):
-    def test(self):
-        self.access_test(8, 'long long')
+        self.access_test(self.size, self.data_type)
 
 class MemTestReadInvalid(SimpleMemoryTest):
     def test(self):
@@ -395,19 +388,18 @@ class MemTestBlock(GdbTest):
                                 readable_binary_string(line_data)))
         assertEqual(highest_seen, self.length)
 
-# Run memory block tests with different reset delays, so hopefully we hit busy
-# at every possible relevant time.
-class MemTestBlock0(MemTestBlock):
-    def test(self):
-        return self.test_block(0)
-
-class MemTestBlock1(MemTestBlock):
-    def test(self):
-        return self.test_block(1)
+class MemTestBlockDelays(MemTestBlock):
+    # Run memory block tests with different reset delays, so hopefully we hit
+    # busy at every possible relevant time.
+    extra_delay = 0
+    variants = {
+        "MemTestBlock0": {"extra_delay": 0},
+        "MemTestBlock1": {"extra_delay": 1},
+        "MemTestBlock2": {"extra_delay": 2},
+    }
 
-class MemTestBlock2(MemTestBlock):
     def test(self):
-        return self.test_block(2)
+        return self.test_block(self.extra_delay)
 
 class DisconnectTest(GdbTest):
     def test(self):
@@ -1456,45 +1448,27 @@ class WriteCsrs(RegsTest):
 
 class DownloadTest(GdbTest):
     compile_args = ("programs/infinite_loop.S", )
+    # How much data to download, unless the target has less RAM than that.
+    length = 2**14
+    # The data is random, but the same every time, so the program only needs
+    # to be built once (see payload.py).
+    seed = 0
 
     def setup(self):
         # pylint: disable=attribute-defined-outside-init
-        length = min(2**18, max(2**10, self.hart.ram_size - 2048))
-        # TODO: remove the next line so we get a bit more code to download. The
-        # line above that allows for more data runs into some error I don't
-        # have time to track down right now.
-        length = min(2**14, max(2**10, self.hart.ram_size - 2048))
-        self.download_c = tempfile.NamedTemporaryFile(prefix="download_",
-                suffix=".c", delete=False)
-        self.download_c.write(b"#include <stdint.h>\n")
-        self.download_c.write(
-                b"unsigned int crc32a(uint8_t *message, unsigned int size);\n")
-        self.download_c.write(b"uint32_t length = %d;\n" % length)
-        self.download_c.write(b"uint8_t d[%d] = {\n" % length)
-        self.crc = 0
+        length = min(self.length, max(2**10, self.hart.ram_size - 2048))
         assert length % 16 == 0
-        for i in range(length // 16):
-            self.download_c.write(("  /* 0x%04x */ " % (i * 16)).encode())
-            for _ in range(16):
-                value = random.randrange(1<<8)
-                self.download_c.write(("0x%02x, " % value).encode())
-                self.crc = binascii.crc32(struct.pack("B", value), self.crc)
-            self.download_c.write(b"\n")
-        self.download_c.write(b"};\n")
-        self.download_c.write(b"uint8_t *data = &d[0];\n")
-        self.download_c.write(
-                b"uint32_t main() { return crc32a(data, length); }\n")
-        self.download_c.flush()
-
-        if self.crc < 0:
-            self.crc += 2**32
+        download_s, self.crc = payload.payload(length, self.seed)
+        # The assembly file finds the data by name, wherever it's kept.
+        include = ("-I", os.path.dirname(download_s))
 
         compiled = {}
         for hart in self.target.harts:
             key = hart.system
             if key not in compiled:
-                compiled[key] = self.target.compile(hart, self.download_c.name,
-                        "programs/checksum.c")
+                # The payload comes first, so each one gets its own binary.
+                compiled[key] = self.target.compile(hart, download_s,
+                        "programs/download.c", "programs/checksum.c", *include)
             self.gdb.select_hart(hart)
             self.gdb.command("file %s" % compiled.get(key))
 
@@ -1507,7 +1481,18 @@ class DownloadTest(GdbTest):
         #self.gdb.c(ops=100)
         self.gdb.c()
         assertEqual(self.gdb.p("status"), self.crc)
-        os.unlink(self.download_c.name)
+
+class DownloadSizeTest(DownloadTest):
+    # Bigger downloads, to see how fast they go. They take a while, so they
+    # only run when asked for by name.
+    opt_in = True
+    variants = {
+        "DownloadTest256K": {"length": 2**18},
+        "DownloadTest1M": {"length": 2**20},
+    }
+
+    def early_applicable(self):
+        return self.length + 2048 <= self.hart.ram_size
 
 #class MprvTest(GdbSingleHartTest):
 #    compile_args = ("programs/mprv.S", )
@@ -1668,6 +1653,8 @@ class VectorTest(GdbSingleHartTest):
     def early_applicable(self):
         if not self.hart.extensionSupported('V'):
             return False
+        if testlib.probe_toolchain().vector_csrs(self.hart.xlen) is False:
+            return False
         # If the compiler can't build this test, say it's not applicable. At
         # some time all compilers will support the V extension, but we're not
         # there yet.
@@ -1826,7 +1813,6 @@ def main():
     global parsed   # pylint: disable=global-statement
     parsed = parser.parse_args()
     target = targets.target(parsed)
-    testlib.print_log_names = parsed.print_log_names
 
     module = sys.modules[__name__]
 
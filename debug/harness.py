@@ -0,0 +1,39 @@
+"""Pieces shared by testlib and the modules it uses or that run tests for it
+(fingerprint.py, worker.py, daemon.py): finding files in the harness
+directory, and the messages exchanged over sockets."""
+
+import json
+import os
+import socket
+
+def find_file(path):
+    for directory in (os.getcwd(), os.path.dirname(__file__)):
+        fullpath = os.path.join(directory, path)
+        relpath = os.path.relpath(fullpath)
+        if len(relpath) >= len(fullpath):
+            relpath = fullpath
+        if os.path.exists(relpath):
+            return relpath
+    return None
+
+def relative_to_harness(path):
+    """Return path relative to the directory this file is in, which is how
+    workers with their own checkout can find it."""
+    return os.path.relpath(os.path.abspath(path),
+            os.path.dirname(os.path.abspath(__file__)))
+
+def parse_address(text):
+    """Parse HOST:PORT or unix:PATH into a socket family and address."""
+    if text.startswith("unix:"):
+        return socket.AF_UNIX, text[len("unix:"):]
+    host, port = text.rsplit(":", 1)
+    return socket.AF_INET, (host or "localhost", int(port))
+
+def send_message(sock, message):
+    sock.sendall((json.dumps(message) + "\n").encode())
+
+def receive_message(reader):
+    line = reader.readline()
+    if not line:
+        raise EOFError("connection closed")
+    return json.loads(line)
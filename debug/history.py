@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+
+"""Timing and outcome history of earlier test runs.
+
+Every test run leaves a log file behind that starts with the test and target
+name, and ends with its result and how long it took. Runs also record the same
+information, together with the git revision and how long each phase of the
+test took, in a small sqlite database next to the log directory. This module
+reads both, so that later runs can make use of it (eg. to start the slowest
+tests first), and can be run to query the database:
+
+    ./history.py durations --target spike64
+    ./history.py flakes
+    ./history.py slowest -n 10
+    ./history.py timings -o timings.json
+"""
+
+import argparse
+import collections
+import json
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import time
+
+# Same as testlib.good_results. Duplicated so that this module can be used
+# without pulling in pexpect.
+good_results = set(('pass', 'not_applicable'))
+
+Run = collections.namedtuple('Run', ('target', 'test', 'result', 'elapsed',
+    'when', 'phases', 'rev', 'hart'), defaults=({}, None, None))
+
+def parse_log(path):
+    """Return a Run describing the test log at path, or None if the log isn't
+    complete (eg. because the test is still running)."""
+    with open(path, "rb") as fd:
+        head = fd.read(256).decode(errors="ignore")
+        fd.seek(0, os.SEEK_END)
+        fd.seek(max(0, fd.tell() - 4096))
+        tail = fd.read().decode(errors="ignore")
+
+    test = re.search(r"^Test: (\S+)$", head, re.MULTILINE)
+    target = re.search(r"^Target: (\S+)$", head, re.MULTILINE)
+    hart = re.search(r"^Hart: (\S+)$", head, re.MULTILINE)
+    result = re.search(r"^Result: (\S+)$", tail, re.MULTILINE)
+    elapsed = re.search(r"^Time elapsed: ([\d.]+)s$", tail, re.MULTILINE)
+    if not (test and target and result and elapsed):
+        return None
+    phases = {}
+    m = re.search(r"^Phases: (.*)$", tail, re.MULTILINE)
+    if m:
+        for part in m.group(1).split():
+            name, value = part.split("=")
+            phases[name] = float(value)
+    return Run(target.group(1), test.group(1), result.group(1),
+            float(elapsed.group(1)), os.path.getmtime(path), phases,
+            hart=hart.group(1) if hart else None)
+
+class History:
+    # How many of the most recent runs of a test to consider when estimating
+    # how long it will take.
+    window = 5
+
+    def __init__(self, runs=()):
+        self.runs = {}
+        for run in runs:
+            self.add(run)
+
+    @staticmethod
+    def from_logs(directory):
+        runs = []
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            names = []
+        for name in names:
+            if not name.endswith(".log"):
+                continue
+            try:
+                run = parse_log(os.path.join(directory, name))
+            except OSError:
+                continue
+            if run:
+                runs.append(run)
+        return History(runs)
+
+    @staticmethod
+    def from_timings(path):
+        """Load a file written by './history.py timings'."""
+        with open(path, encoding="utf-8") as fd:
+            timings = json.load(fd)
+        return History(Run(target, test, "pass", elapsed, 0)
+                for target, tests in timings.items()
+                for test, elapsed in tests.items())
+
+    def timings(self):
+        """Return the expected duration of every test on every target, as
+        {target: {test: seconds}}."""
+        result = {}
+        for target, test in self.runs:
+            result.setdefault(target, {})[test] = \
+                    self.expected_duration(target, test)
+        return result
+
+    def add(self, run):
+        self.runs.setdefault((run.target, run.test), []).append(run)
+
+    def recent(self, target, test):
+        """Return the most recent runs of test on target, oldest first."""
+        runs = sorted(self.runs.get((target, test), ()), key=lambda r: r.when)
+        return runs[-self.window:]
+
+    def expected_duration(self, target, test):
+        """Return how long test is expected to take on target, or None if it
+        has never been run there."""
+        runs = self.recent(target, test)
+        if not runs:
+            return None
+        return sum(run.elapsed for run in runs) / len(runs)
+
+    def recently_failed(self, target, test):
+        runs = self.recent(target, test)
+        return bool(runs) and runs[-1].result not in good_results
+
+def order(history, target, names, longest_first=False, failures_first=False):
+    """Return names (of tests that will run on target) sorted according to the
+    given policy. The sort is stable, so without any policy the order is
+    unchanged. Tests that have never been run are assumed to be slow, since we
+    know nothing about them."""
+    def key(name):
+        parts = []
+        if failures_first:
+            parts.append(not history.recently_failed(target, name))
+        if longest_first:
+            duration = history.expected_duration(target, name)
+            parts.append(-float("inf") if duration is None else -duration)
+        return parts
+
+    return sorted(names, key=key)
+
+def shard(history, target, names, index, count):
+    """Split names (of tests that will run on target) into count shards, and
+    return the ones in shard index (0-based), in their original order.
+
+    When history knows how long tests take, they are handed out longest first
+    to whichever shard has the least work so far, so that shards finish at
+    about the same time. Tests without history count as taking as long as the
+    median test. Without any history at all this degenerates to splitting by
+    count. The split only depends on names and history, so every shard computes
+    the same one as long as they are given the same history."""
+    durations = {}
+    for name in names:
+        durations[name] = history.expected_duration(target, name)
+    known = [d for d in durations.values() if d is not None]
+    default = percentile(known, 0.5) or 1
+    for name, duration in durations.items():
+        if duration is None:
+            durations[name] = default
+
+    loads = [0] * count
+    assignment = {}
+    for name in sorted(names, key=lambda n: (-durations[n], n)):
+        chosen = loads.index(min(loads))
+        assignment[name] = chosen
+        loads[chosen] += durations[name]
+    return [name for name in names if assignment[name] == index]
+
+def budget(history, target, names, seconds, changed=()):
+    """Choose which of names (tests that would run on target) to run, so that
+    they're expected to take no more than seconds. Return the chosen names and
+    the rest, both in their original order.
+
+    Tests that failed the last time they ran come first, then tests in
+    changed (whose inputs changed since they last ran), and within each of
+    those groups the cheapest tests come first, so that as many tests as
+    possible fit. Tests without history count as taking as long as the median
+    test."""
+    durations = {}
+    for name in names:
+        durations[name] = history.expected_duration(target, name)
+    known = [d for d in durations.values() if d is not None]
+    default = percentile(known, 0.5) or 1
+    for name, duration in durations.items():
+        if duration is None:
+            durations[name] = default
+
+    def key(name):
+        return (not history.recently_failed(target, name),
+                name not in changed, durations[name], name)
+
+    chosen = set()
+    total = 0
+    for name in sorted(set(names), key=key):
+        if total + durations[name] <= seconds:
+            chosen.add(name)
+            total += durations[name]
+    return [name for name in names if name in chosen], \
+            [name for name in names if name not in chosen]
+
+def percentile(values, fraction):
+    """Return the value below which fraction of values fall (nearest
+    rank)."""
+    values = sorted(values)
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, int(fraction * len(values) + 0.5) - 1))
+    return values[index]
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+                ["git", "describe", "--always", "--dirty"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def default_path(logs):
+    """Return the path of the database that belongs with log directory
+    logs."""
+    return os.path.normpath(logs) + ".sqlite"
+
+class Database:
+    def __init__(self, path):
+        self.path = path
+        # Several test runs may share one database, so wait for the lock
+        # rather than fail.
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS runs (
+                when_ REAL, target TEXT, test TEXT, result TEXT,
+                elapsed REAL, phases TEXT, rev TEXT, log TEXT)""")
+        self.connection.execute("""CREATE INDEX IF NOT EXISTS runs_test
+                ON runs (target, test)""")
+        columns = [row[1] for row in
+                self.connection.execute("PRAGMA table_info(runs)")]
+        if "inputs" not in columns:
+            self.connection.execute("ALTER TABLE runs ADD COLUMN inputs TEXT")
+        # Whether a test (identified by its inputs) applies to a hart.
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS verdicts (
+                inputs TEXT, hart INTEGER, applicable INTEGER,
+                PRIMARY KEY (inputs, hart))""")
+        self.connection.commit()
+        self.rev = None
+
+    def record(self, target, test, result, elapsed, *, log_name=None,
+            inputs=None, phases=None):
+        """Record one result. Phase timings are taken from the test's log,
+        unless they're given. inputs is the test's fingerprint, if it was
+        computed."""
+        if self.rev is None:
+            self.rev = git_revision()
+        if phases is None and log_name:
+            phases = {}
+            try:
+                run = parse_log(log_name)
+                if run:
+                    phases = run.phases
+            except OSError:
+                pass
+        self.connection.execute(
+                "INSERT INTO runs (when_, target, test, result, elapsed, "
+                "phases, rev, log, inputs) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), target, test, result, elapsed,
+                    json.dumps(phases or {}), self.rev, log_name, inputs))
+        self.connection.commit()
+
+    def passed(self, target, test, inputs):
+        """Return the log of the last time test passed on target with exactly
+        these inputs, or None if it never did."""
+        row = self.connection.execute(
+                "SELECT log FROM runs WHERE target = ? AND test = ? AND "
+                "inputs = ? AND result = 'pass' ORDER BY when_ DESC LIMIT 1",
+                (target, test, inputs)).fetchone()
+        if row:
+            return row[0] or ""
+        return None
+
+    def verdict(self, inputs, hart):
+        """Return whether the test with these inputs applies to hart (an
+        index into the target's harts), or None if that isn't known."""
+        row = self.connection.execute(
+                "SELECT applicable FROM verdicts WHERE inputs = ? AND "
+                "hart = ?", (inputs, hart)).fetchone()
+        if row:
+            return bool(row[0])
+        return None
+
+    def record_verdict(self, inputs, hart, applicable):
+        self.connection.execute(
+                "INSERT OR REPLACE INTO verdicts (inputs, hart, applicable) "
+                "VALUES (?, ?, ?)", (inputs, hart, int(applicable)))
+        self.connection.commit()
+
+    def runs(self, target=None):
+        query = "SELECT target, test, result, elapsed, when_, phases, rev " \
+                "FROM runs"
+        args = ()
+        if target:
+            query += " WHERE target = ?"
+            args = (target,)
+        return [Run(row[0], row[1], row[2], row[3], row[4],
+            json.loads(row[5] or "{}"), row[6])
+            for row in self.connection.execute(query, args)]
+
+def load(path, logs):
+    """Return a History from the database at path (or the default one for
+    logs), falling back to the log files themselves when the database doesn't
+    have anything yet."""
+    if path != "none":
+        path = path or default_path(logs)
+        if os.path.exists(path):
+            runs = Database(path).runs()
+            if runs:
+                return History(runs)
+    return History.from_logs(logs)
+
+def group(runs):
+    grouped = {}
+    for run in runs:
+        grouped.setdefault((run.target, run.test), []).append(run)
+    return grouped
+
+def flake_rate(runs):
+    """Return the fraction of runs that failed at a revision where the same
+    test also passed. Failures at revisions where the test never passed are
+    real failures, not flakes."""
+    by_rev = {}
+    for run in runs:
+        by_rev.setdefault(run.rev, []).append(run.result in good_results)
+    flaky = sum(outcomes.count(False) for outcomes in by_rev.values()
+            if any(outcomes))
+    return flaky / len(runs)
+
+def quarantine(history, target, threshold):
+    """Return the tests that ran on target and whose flake rate is at least
+    threshold."""
+    return sorted(test for (t, test), runs in history.runs.items()
+            if t == target and 0 < flake_rate(runs) >= threshold)
+
+def print_durations(grouped, phases):
+    print(f"{'target':<16} {'test':<36} {'runs':>5} {'p50':>8} {'p95':>8}")
+    for (target, test), runs in sorted(grouped.items()):
+        elapsed = [run.elapsed for run in runs]
+        print(f"{target:<16} {test:<36} {len(runs):5d} "
+                f"{percentile(elapsed, 0.5):7.1f}s "
+                f"{percentile(elapsed, 0.95):7.1f}s")
+        if phases:
+            names = sorted(set(name for run in runs for name in run.phases))
+            for name in names:
+                values = [run.phases[name] for run in runs
+                        if name in run.phases]
+                print(f"{'':<16}   {name:<34} {len(values):5d} "
+                        f"{percentile(values, 0.5):7.1f}s "
+                        f"{percentile(values, 0.95):7.1f}s")
+
+def print_flakes(grouped, show_all):
+    print(f"{'target':<16} {'test':<36} {'runs':>5} {'fail':>6} {'flaky':>6}")
+    rows = []
+    for (target, test), runs in grouped.items():
+        rate = flake_rate(runs)
+        failed = sum(1 for run in runs if run.result not in good_results)
+        if rate or show_all:
+            rows.append((rate, target, test, len(runs), failed))
+    for rate, target, test, count, failed in sorted(rows, reverse=True):
+        print(f"{target:<16} {test:<36} {count:5d} {failed:6d} "
+                f"{100 * rate:5.1f}%")
+
+def print_slowest(grouped, count):
+    rows = sorted(((percentile([run.elapsed for run in runs], 0.5), key)
+        for key, runs in grouped.items()), reverse=True)
+    print(f"{'target':<16} {'test':<36} {'p50':>8}")
+    for p50, (target, test) in rows[:count]:
+        print(f"{target:<16} {test:<36} {p50:7.1f}s")
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Query the results recorded by earlier test runs.")
+    parser.add_argument("--db", default=default_path("logs"),
+            help="Database to read. Defaults to %(default)s.")
+    parser.add_argument("--target", help="Only show results for this target.")
+    parser.add_argument("--rev",
+            help="Only show results for this git revision.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    durations = subparsers.add_parser("durations",
+            help="Show p50 and p95 durations of tests.")
+    durations.add_argument("--phases", action="store_true",
+            help="Also show durations of each phase of every test.")
+    durations.add_argument("test", nargs="*",
+            help="Only show tests whose name contains one of these.")
+    flakes = subparsers.add_parser("flakes",
+            help="Show how often tests fail at revisions where they also "
+            "passed.")
+    flakes.add_argument("--all", action="store_true",
+            help="Also show tests that never flaked.")
+    slowest = subparsers.add_parser("slowest",
+            help="Show the tests with the highest p50 duration.")
+    slowest.add_argument("-n", type=int, default=20,
+            help="How many tests to show.")
+    timings = subparsers.add_parser("timings",
+            help="Write the expected duration of every test as JSON, for use "
+            "with --shard-timings.")
+    timings.add_argument("-o", "--output", default="-",
+            help="File to write to. Defaults to stdout.")
+    parsed = parser.parse_args()
+
+    if not os.path.exists(parsed.db):
+        print(f"{parsed.db} does not exist")
+        return 1
+    runs = Database(parsed.db).runs(parsed.target)
+    if parsed.rev:
+        runs = [run for run in runs if run.rev == parsed.rev]
+    if parsed.command == "durations" and parsed.test:
+        runs = [run for run in runs
+                if any(test in run.test for test in parsed.test)]
+    grouped = group(runs)
+
+    if parsed.command == "durations":
+        print_durations(grouped, parsed.phases)
+    elif parsed.command == "flakes":
+        print_flakes(grouped, parsed.all)
+    elif parsed.command == "slowest":
+        print_slowest(grouped, parsed.n)
+    elif parsed.command == "timings":
+        text = json.dumps(History(runs).timings(), indent=2, sort_keys=True)
+        if parsed.output == "-":
+            print(text)
+        else:
+            with open(parsed.output, "w", encoding="utf-8") as fd:
+                fd.write(text + "\n")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
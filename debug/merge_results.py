@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+
+"""Combine the results files written by several runs of gdbserver.py (eg. one
+per --shard) into one summary, and exit with the same code a single run over
+all the tests would have."""
+
+import argparse
+import sys
+
+import testlib
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Merge results files written with --results.")
+    parser.add_argument("results", nargs="+",
+            help="Results files to merge.")
+    parsed = parser.parse_args()
+
+    results = testlib.read_results(parsed.results)
+    count = sum(len(value) for value in results.values())
+    testlib.header(f"{count} tests in {len(parsed.results)} results files",
+            dash=':')
+    return testlib.print_results(results)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+"""Random data for DownloadTest to download and checksum.
+
+The data is generated in one go from a seed, and written to a file that a tiny
+assembly file pulls in with .incbin, which is much faster to build than a C
+array initializer once the data gets big. Both files are kept on disk by seed
+and size, so the same payload (and so the same program, as far as the compile
+cache is concerned) is only generated once. The assembly file refers to the
+data by name only, so it has to be built with -I and the directory both are
+in, and is the same on every machine."""
+
+import binascii
+import os
+import random
+import tempfile
+
+ASSEMBLY = """    .data
+    .globl d
+    .balign 16
+d:
+    .incbin "%(data)s"
+
+    .globl length
+    .balign 4
+length:
+    .word %(length)d
+"""
+
+def default_path():
+    base = os.environ.get("XDG_CACHE_HOME") or \
+            os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "riscv-tests-debug", "payloads")
+
+def fallback_path():
+    return os.path.join(tempfile.gettempdir(),
+            f"riscv-tests-debug-{os.getuid()}", "payloads")
+
+def write(path, contents):
+    """Write contents to path, so that nobody ever sees part of it."""
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as out:
+        out.write(contents)
+    os.replace(temporary, path)
+
+def payload(length, seed, directory=None):
+    """Return the path of an assembly file that defines `uint8_t d[length]`,
+    filled with random data from seed, and `uint32_t length`, and the CRC32 of
+    that data. The files are kept in directory, or by default in ~/.cache (or
+    a temporary directory if that can't be written)."""
+    if directory:
+        return write_payload(directory, length, seed)
+    try:
+        return write_payload(default_path(), length, seed)
+    except OSError:
+        # Eg. a read-only home directory.
+        return write_payload(fallback_path(), length, seed)
+
+def write_payload(directory, length, seed):
+    os.makedirs(directory, exist_ok=True)
+    name = f"download_{seed}_{length}"
+    data_path = os.path.join(directory, name + ".bin")
+    assembly_path = os.path.join(directory, name + ".S")
+
+    try:
+        with open(data_path, "rb") as fd:
+            data = fd.read()
+    except OSError:
+        data = None
+    if data is None or len(data) != length:
+        data = random.Random(seed).randbytes(length)
+        write(data_path, data)
+
+    assembly = (ASSEMBLY % {"data": name + ".bin", "length": length}).encode()
+    try:
+        with open(assembly_path, "rb") as fd:
+            current = fd.read()
+    except OSError:
+        current = None
+    if current != assembly:
+        write(assembly_path, assembly)
+
+    return assembly_path, binascii.crc32(data)
@@ -0,0 +1,11 @@
+#include <stdint.h>
+
+// Defined by the assembly file DownloadTest generates (see payload.py).
+extern uint8_t d[];
+extern uint32_t length;
+
+unsigned int crc32a(uint8_t *message, unsigned int size);
+
+uint8_t *data = &d[0];
+
+uint32_t main() { return crc32a(data, length); }
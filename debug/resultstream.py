@@ -0,0 +1,127 @@
+"""Machine-readable results, written as each test finishes so that they can
+be followed while a run is in progress, and survive a run that dies.
+
+--jsonl appends one JSON object per test. --junit appends each test to a JUnit
+XML file, which is closed again after every test so that it is always
+complete."""
+
+import json
+import os
+import time
+import xml.etree.ElementTree as ET
+
+# Results that mean a test didn't run, rather than that it passed.
+skipped_results = set(('not_applicable',))
+# Results that mean the test ran and reported a problem, as opposed to the
+# harness (or something the test depends on) falling over.
+failed_results = set(('fail',))
+passed_results = set(('pass', 'cached-pass'))
+# How much of the end of each log goes into the JUnit file. The whole log is
+# named in a property.
+log_tail_bytes = 64 * 1024
+
+def record(*, target, test, hart, result, elapsed, phases, log_name):
+    return {
+            "time": time.time(),
+            "target": target,
+            "test": test,
+            "hart": hart,
+            "result": result,
+            "elapsed": elapsed,
+            "phases": phases,
+            "log": log_name
+            }
+
+def read_log_tail(log_name):
+    """Return the last log_tail_bytes of log_name, or None."""
+    if not log_name:
+        return None
+    try:
+        with open(log_name, "rb") as fd:
+            size = fd.seek(0, os.SEEK_END)
+            fd.seek(max(0, size - log_tail_bytes))
+            tail = fd.read()
+    except OSError:
+        return None
+    text = tail.decode("utf-8", errors="replace")
+    if size > log_tail_bytes:
+        text = f"[... first {size - len(tail)} bytes omitted ...]\n" + text
+    return text
+
+class JsonLines:
+    def __init__(self, path):
+        # Kept open for the whole run.
+        # pylint: disable=consider-using-with
+        self.fd = open(path, "a", encoding="utf-8")
+
+    def add(self, entry):
+        self.fd.write(json.dumps(entry) + "\n")
+        self.fd.flush()
+
+class JUnit:
+    """Each test is written as soon as it finishes, followed by the closing
+    tags, which the next test overwrites. A target gets one testsuite for as
+    long as its tests keep coming."""
+    trailer = b"</testsuite>\n</testsuites>\n"
+
+    def __init__(self, path):
+        # Kept open for the whole run.
+        # pylint: disable=consider-using-with
+        self.fd = open(path, "wb")
+        self.fd.write(b"<?xml version='1.0' encoding='utf-8'?>\n"
+                b"<testsuites>\n")
+        self.end = self.fd.tell()
+        self.target = None
+        self.fd.write(b"</testsuites>\n")
+        self.fd.flush()
+
+    def add(self, entry):
+        text = ""
+        if entry["target"] != self.target:
+            if self.target is not None:
+                text += "</testsuite>\n"
+            suite = ET.Element("testsuite", name=entry["target"])
+            # Only the opening tag; the testcases follow.
+            text += ET.tostring(suite, encoding="unicode")[:-3] + ">\n"
+            self.target = entry["target"]
+        text += ET.tostring(self.testcase(entry), encoding="unicode") + "\n"
+
+        self.fd.seek(self.end)
+        self.fd.write(text.encode("utf-8"))
+        self.end = self.fd.tell()
+        self.fd.write(self.trailer)
+        self.fd.truncate()
+        self.fd.flush()
+
+    @staticmethod
+    def testcase(entry):
+        case = ET.Element("testcase", classname=entry["target"],
+                name=entry["test"], time=f"{entry['elapsed']:.3f}")
+        if entry["log"]:
+            properties = ET.SubElement(case, "properties")
+            ET.SubElement(properties, "property", name="log",
+                    value=entry["log"])
+        if entry["result"] in skipped_results:
+            ET.SubElement(case, "skipped", message=entry["result"])
+        elif entry["result"] in failed_results:
+            ET.SubElement(case, "failure", message=entry["result"])
+        elif entry["result"] not in passed_results:
+            ET.SubElement(case, "error", message=entry["result"])
+        output = read_log_tail(entry["log"])
+        if output is not None:
+            ET.SubElement(case, "system-out").text = output
+        return case
+
+# Writers by path, so that every target in a batch.py run appends to the same
+# files instead of starting them over.
+writers = {}
+
+def open_writers(parsed):
+    """Return the writers selected on the command line."""
+    found = []
+    for path, cls in ((parsed.jsonl, JsonLines), (parsed.junit, JUnit)):
+        if path:
+            if path not in writers:
+                writers[path] = cls(path)
+            found.append(writers[path])
+    return found
@@ -1,10 +1,19 @@
+import hashlib
 import importlib
 import os.path
 import re
 import sys
 import tempfile
+import threading
 
 import testlib
+import toolchain
+
+# Sources that every program is linked with, plus some that many tests list.
+# Unless a target sets prebuilt_runtime to False, they're compiled once into a
+# library for each set of options (see Target.runtime()).
+RUNTIME_SOURCES = ("programs/entry.S", "programs/init.c",
+        "programs/checksum.c", "programs/tiny-malloc.c")
 
 class Hart:
     # XLEN of the hart. May be overridden with --32 or --64 command line
@@ -76,6 +85,11 @@ class Target:
     # GDB remotetimeout setting.
     timeout_sec = 2
 
+    # Wall-clock budget for a whole test, in seconds. A test that takes longer
+    # is killed, together with the simulator, server and gdb it started, and
+    # reported as a timeout. None means no limit. Overridden by --timeout.
+    test_timeout_sec = None
+
     # Timeout waiting for the server to start up. This is different than the
     # GDB timeout, which is how long GDB waits for commands to execute.
     # The server_timeout is how long this script waits for the server to be
@@ -126,9 +140,17 @@ class Target:
     # in https://github.com/FreeRTOS/FreeRTOS.
     freertos_binary = None
 
+    # Compile the code every program needs (RUNTIME_SOURCES) once into a
+    # library that's shared by all programs built with the same options,
+    # instead of into every program. Set False to go back to the latter.
+    prebuilt_runtime = True
+
     # Internal variables:
     directory = None
     temporary_files = []
+    # Libraries built by runtime(), and a lock for each one.
+    runtimes = {}
+    runtime_locks = {}
 
     def __init__(self, path, parsed):
         # Path to module.
@@ -138,7 +160,7 @@ class Target:
         self.sim_cmd = parsed.sim_cmd
         self.temporary_binary = None
         self.compiler_supports_v = True
-        Target.isolate = parsed.isolate
+        Target.isolate = parsed.isolate or parsed.jobs > 1
         if not self.name:
             self.name = type(self).__name__
         # Default OpenOCD config file to <name>.cfg
@@ -169,46 +191,85 @@ class Target:
                 freertos=test.freertos())
 
     def do_compile(self, hart, *sources):
-        binary_name = "%s_%s-%x" % (
-                self.name,
-                os.path.basename(os.path.splitext(sources[0])[0]),
-                hart.misa)
+        # Programs that share their first source but not the rest (eg.
+        # infinite_loop.S with and without -DMULTICORE) may be built at the
+        # same time, so they need names of their own.
+        stem = os.path.basename(os.path.splitext(sources[0])[0])
+        digest = hashlib.sha256(repr(sources).encode()).hexdigest()[:8]
+        binary_name = f"{self.name}_{stem}-{hart.misa:x}-{digest}"
         if Target.isolate:
             self.temporary_binary = tempfile.NamedTemporaryFile(
                     prefix=binary_name + "_")
             binary_name = self.temporary_binary.name
             Target.temporary_files.append(self.temporary_binary)
 
-        args = list(sources) + [
-                "programs/entry.S", "programs/init.c",
-                "-DNHARTS=%d" % len(self.harts),
+        options = [
+                f"-DNHARTS={len(self.harts)}",
                 "-I", "../env",
-                "-T", hart.link_script_path,
-                "-nostartfiles",
                 "-mcmodel=medany",
-                "-DXLEN=%d" % hart.xlen,
-                "-o", binary_name]
+                f"-DXLEN={hart.xlen}"]
 
         if hart.extensionSupported('e'):
-            args.append("-march=rv32e")
-            args.append("-mabi=ilp32e")
-            args.append("-DRV32E")
+            options.append("-march=rv32e")
+            options.append("-mabi=ilp32e")
+            options.append("-DRV32E")
         else:
-            march = "rv%dima" % hart.xlen
+            abi = toolchain.mabi(hart.xlen)
+            march = f"rv{hart.xlen}ima"
             for letter in "fdc":
                 if hart.extensionSupported(letter):
                     march += letter
-            if hart.extensionSupported("v") and self.compiler_supports_v:
+            # Ask whether the compiler supports V before trying, but if it
+            # can't be asked, try anyway.
+            if hart.extensionSupported("v") and self.compiler_supports_v and \
+                    testlib.probe_toolchain().supports_march(march + "v",
+                            abi) is not False:
                 march += "v"
-            args.append("-march=%s" % march)
-            if hart.xlen == 32:
-                args.append("-mabi=ilp32")
-            else:
-                args.append("-mabi=lp%d" % hart.xlen)
+            options.append(f"-march={march}")
+            options.append(f"-mabi={abi}")
+
+        if self.prebuilt_runtime:
+            # The test's defines (eg. -DMULTICORE or -DDEFINE_MALLOC) change
+            # what the runtime sources do too.
+            defines = [s for s in sources if s.startswith("-D")]
+            library = self.runtime(defines + options)
+            # Runtime sources the test lists are linked in whole, like they
+            # were before. Nothing refers to _start, so the linker has to be
+            # told to take it (and what it needs) from the library.
+            args = [runtime_object(library, s) if s in RUNTIME_SOURCES else s
+                    for s in sources] + ["-u", "_start", library]
+        else:
+            args = list(sources) + ["programs/entry.S", "programs/init.c"]
+        args += options + [
+                "-T", hart.link_script_path,
+                "-nostartfiles",
+                "-o", binary_name]
 
         testlib.compile(args)
         return binary_name
 
+    def runtime(self, options):
+        """Return a static library of RUNTIME_SOURCES compiled with options,
+        building it unless that was done before. The objects and the library
+        end up in the compile cache (see compilecache.py), so later runs don't
+        have to build either."""
+        key = (testlib.session().gcc_cmd, tuple(options))
+        with Target.runtime_locks.setdefault(key, threading.Lock()):
+            if key not in Target.runtimes:
+                # Kept until exit, in Target.temporary_files.
+                # pylint: disable=consider-using-with
+                directory = tempfile.TemporaryDirectory(prefix="runtime_")
+                Target.temporary_files.append(directory)
+                library = os.path.join(directory.name, "libruntime.a")
+                objects = []
+                for source in RUNTIME_SOURCES:
+                    objects.append(runtime_object(library, source))
+                    testlib.compile(["-c", source] + options +
+                            ["-o", objects[-1]])
+                testlib.archive(library, objects)
+                Target.runtimes[key] = library
+        return Target.runtimes[key]
+
     def compile(self, hart, *sources):
         for _ in range(2):
             try:
@@ -227,9 +288,15 @@ class Target:
                 else:
                     raise
 
-def add_target_options(parser):
-    parser.add_argument("target", help=".py file that contains definition for "
-            "the target to test with.")
+def runtime_object(library, source):
+    """Return the object file source was compiled to for library."""
+    return os.path.join(os.path.dirname(library),
+            os.path.basename(source) + ".o")
+
+def add_target_options(parser, positional=True):
+    if positional:
+        parser.add_argument("target", help=".py file that contains definition "
+                "for the target to test with.")
     parser.add_argument("--sim_cmd",
             help="The command to use to start the actual target (e.g. "
             "simulation)", default="spike")
@@ -1,33 +1,159 @@
+import argparse
 import collections
+import concurrent.futures
+import contextlib
+import copy
+import importlib.util
+import io
+import json
+import multiprocessing
+import multiprocessing.connection
 import os
 import os.path
+import queue
 import random
 import re
 import shlex
+import signal
+import socket
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import traceback
 import pipes
 
 import pexpect
 
-print_log_names = False
-real_stdout = sys.stdout
+import compilecache
+import fingerprint
+import harness
+import history
+import resultstream
+import toolchain
 
 # Note that gdb comes with its own testsuite. I was unable to figure out how to
 # run that testsuite against the spike simulator.
 
-def find_file(path):
-    for directory in (os.getcwd(), os.path.dirname(__file__)):
-        fullpath = os.path.join(directory, path)
-        relpath = os.path.relpath(fullpath)
-        if len(relpath) >= len(fullpath):
-            relpath = fullpath
-        if os.path.exists(relpath):
-            return relpath
-    return None
+class SessionStdout:
+    """Installed as sys.stdout, so that every thread's output goes to the log
+    of whatever test that thread's session is running."""
+    def __init__(self, console):
+        self.console = console
+
+    def stream(self):
+        return session().stdout or self.console
+
+    def write(self, text):
+        return self.stream().write(text)
+
+    def flush(self):
+        return self.stream().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream(), name)
+
+class Session:
+    """State that belongs to one simulator/server/gdb stack, rather than to the
+    whole process: which commands to run, the environment passed to the
+    processes the stack starts (eg. the port spike is listening on), and where
+    output goes.
+
+    A session is made current for the calling thread by using it as a context
+    manager. Code that isn't running inside one uses default_session."""
+    # pylint: disable=too-many-instance-attributes
+    local = threading.local()
+
+    def __init__(self, gdb_cmd=None, gcc_cmd=None, print_log_names=False,
+            compile_cache=None):
+        self.gdb_cmd = gdb_cmd
+        self.gcc_cmd = gcc_cmd
+        # compilecache.Cache that compile() uses, or None.
+        self.compile_cache = compile_cache
+        self.print_log_names = print_log_names
+        self.env = {}
+        # Where output goes while a test is capturing it, or None.
+        self.stdout = None
+        self.saved = []
+        # Stack left behind by the last test, for the next one to use (see
+        # --share-stacks).
+        self.stack = None
+        # Whether to keep that stack when the session is exited, so that it
+        # can be used the next time the session is entered (see --watch).
+        self.keep_stack = False
+
+    @classmethod
+    def from_parsed(cls, parsed):
+        return cls(gdb_cmd=parsed.gdb, gcc_cmd=parsed.gcc,
+                print_log_names=parsed.print_log_names,
+                compile_cache=compilecache.open_cache(parsed))
+
+    @property
+    def real_stdout(self):
+        """The console, even while output is being captured."""
+        if isinstance(sys.stdout, SessionStdout):
+            return sys.stdout.console
+        return sys.stdout
+
+    def __enter__(self):
+        self.saved.append(getattr(Session.local, 'session', None))
+        Session.local.session = self
+        return self
+
+    def __exit__(self, _type, _value, _traceback):
+        Session.local.session = self.saved.pop()
+        if not self.keep_stack:
+            self.drop_stack()
+
+    def take_stack(self, key=None):
+        """Return the stack the last test left behind, and forget it. key is
+        the stack_key() of the test asking, for sessions that keep more than
+        one stack (see daemon.py)."""
+        # pylint: disable=unused-argument
+        stack = self.stack
+        self.stack = None
+        return stack
+
+    def drop_stack(self):
+        # The simulator, server and gdb shut down when they're deleted.
+        self.stack = None
+
+    def capture(self, stream):
+        """Send everything this session's thread prints to stream, until
+        release() is called."""
+        if not isinstance(sys.stdout, SessionStdout):
+            sys.stdout = SessionStdout(sys.stdout)
+        self.stdout = stream
+
+    def release(self):
+        self.stdout = None
+
+    def log_name(self, kind, name):
+        if self.print_log_names:
+            self.real_stdout.write("Temporary %s log: %s\n" % (kind, name))
+        if self.stdout:
+            # Also note it in the test's own log, so that the log can still be
+            # collected if the test is killed (see Watchdog).
+            self.stdout.write(f"Temporary {kind} log: {name}\n")
+
+    def started(self, kind, pid):
+        """Note a process that isn't in the process group of the test that
+        started it (eg. gdb, which pexpect runs in a session of its own), in
+        the test's log, so that it can still be killed if the test is (see
+        Watchdog)."""
+        if self.stdout:
+            self.stdout.write(f"Started {kind} process: {pid}\n")
+
+    def environ(self):
+        """Environment for processes started as part of this session."""
+        return {**os.environ, **self.env}
+
+default_session = Session()
+
+def session():
+    """Return the session that the calling thread is running in."""
+    return getattr(Session.local, 'session', None) or default_session
 
 class CompileError(Exception):
     def __init__(self, stdout, stderr):
@@ -35,21 +161,37 @@ class CompileError(Exception):
         self.stdout = stdout
         self.stderr = stderr
 
-gcc_cmd = None
 def compile(args): # pylint: disable=redefined-builtin
+    gcc_cmd = session().gcc_cmd
     if gcc_cmd:
         cmd = [gcc_cmd]
     else:
         cmd = ["riscv64-unknown-elf-gcc"]
     cmd.append("-g")
     for arg in args:
-        found = find_file(arg)
+        found = harness.find_file(arg)
         if found:
             cmd.append(found)
         else:
             cmd.append(arg)
     header("Compile")
+    output = cmd[cmd.index("-o") + 1] if "-o" in cmd[:-1] else None
+    build(cmd, output, cmd[1:])
+
+def build(cmd, output, key_args):
+    """Run cmd, which writes output, unless the compile cache (see
+    compilecache.py) already has what it would write for key_args, in which
+    case take it from there. Add what cmd wrote to the cache."""
     print("+", " ".join(cmd))
+
+    cache = session().compile_cache
+    key = None
+    if cache and output:
+        key = cache.key(cmd[0], key_args)
+        if key and cache.get(key, output):
+            print(f"Found in {cache.entry(key)}")
+            return
+
     process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
                                stderr=subprocess.PIPE)
     stdout, stderr = process.communicate()
@@ -58,6 +200,34 @@ def compile(args): # pylint: disable=redefined-builtin
         print(stderr.decode('ascii'), end=" ")
         header("")
         raise CompileError(stdout, stderr)
+    if key:
+        cache.put(key, output)
+
+# toolchain.Toolchain for each gcc command, see probe_toolchain().
+toolchains = {}
+
+def probe_toolchain():
+    """Return what's known about the gcc that compile() uses."""
+    gcc_cmd = session().gcc_cmd or "riscv64-unknown-elf-gcc"
+    if gcc_cmd not in toolchains:
+        toolchains[gcc_cmd] = toolchain.Toolchain(gcc_cmd)
+    return toolchains[gcc_cmd]
+
+def archive(library, objects):
+    """Bundle objects into the static library at library, using the ar that
+    comes with the gcc compile() uses. Like programs, libraries are kept in
+    the compile cache, so ar doesn't have to run (or even exist) for objects
+    that were archived before."""
+    gcc_cmd = session().gcc_cmd or "riscv64-unknown-elf-gcc"
+    if gcc_cmd.endswith("gcc"):
+        ar_cmd = gcc_cmd[:-len("gcc")] + "ar"
+    else:
+        ar_cmd = "riscv64-unknown-elf-ar"
+    # D leaves timestamps out, so that the library's contents (and so the
+    # compile cache key of programs linked with it) only depend on the
+    # objects.
+    build([ar_cmd, "rcsD", library] + list(objects), library,
+            ["rcsD"] + list(objects))
 
 class Spike:
     # pylint: disable=too-many-instance-attributes
@@ -90,8 +260,7 @@ class Spike:
                 suffix=".log")
         logname = self.logfile.name
         self.lognames = [logname]
-        if print_log_names:
-            real_stdout.write("Temporary spike log: %s\n" % logname)
+        session().log_name("spike", logname)
         self.logfile.write(("+ %s\n" % " ".join(cmd)).encode())
         self.logfile.flush()
         self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE,
@@ -104,7 +273,7 @@ class Spike:
                         r"port (\d+).", open(logname).read())
                 if m:
                     self.port = int(m.group(1))
-                    os.environ['REMOTE_BITBANG_PORT'] = m.group(1)
+                    session().env['REMOTE_BITBANG_PORT'] = m.group(1)
                     break
                 time.sleep(0.11)
             if not self.port:
@@ -159,7 +328,7 @@ class Spike:
                 "All spike harts must have the same RAM layout"
         assert len(set(t.ram_size for t in self.harts)) == 1, \
                 "All spike harts must have the same RAM layout"
-        os.environ['WORK_AREA'] = '0x%x' % self.harts[0].ram
+        session().env['WORK_AREA'] = '0x%x' % self.harts[0].ram
         cmd += ["-m0x%x:0x%x" % (self.harts[0].ram, self.harts[0].ram_size)]
 
         if timeout:
@@ -169,7 +338,7 @@ class Spike:
             cmd.append('-H')
         if with_jtag_gdb:
             cmd += ['--rbb-port', '0']
-            os.environ['REMOTE_BITBANG_HOST'] = 'localhost'
+            session().env['REMOTE_BITBANG_HOST'] = 'localhost'
 
         return cmd
 
@@ -215,8 +384,8 @@ class MultiSpike:
             raise Exception("Didn't get daisy chain message about which port "
                             "it's listening on.")
 
-        os.environ['REMOTE_BITBANG_HOST'] = 'localhost'
-        os.environ['REMOTE_BITBANG_PORT'] = str(self.port)
+        session().env['REMOTE_BITBANG_HOST'] = 'localhost'
+        session().env['REMOTE_BITBANG_PORT'] = str(self.port)
 
     def __del__(self):
         if self.process:
@@ -227,10 +396,10 @@ class MultiSpike:
                 pass
 
 class VcsSim:
-    logfile = tempfile.NamedTemporaryFile(prefix='simv', suffix='.log')
-    logname = logfile.name
-
     def __init__(self, sim_cmd=None, debug=False, timeout=300):
+        self.logfile = tempfile.NamedTemporaryFile(prefix='simv', suffix='.log')
+        self.logname = self.logfile.name
+
         if sim_cmd:
             cmd = shlex.split(sim_cmd)
         else:
@@ -241,8 +410,7 @@ class VcsSim:
             cmd += ["+vcdplusfile=output/gdbserver.vpd"]
 
         logfile = open(self.logname, "w")
-        if print_log_names:
-            real_stdout.write("Temporary VCS log: %s\n" % self.logname)
+        session().log_name("VCS", self.logname)
         logfile.write("+ %s\n" % " ".join(cmd))
         logfile.flush()
 
@@ -266,7 +434,7 @@ class VcsSim:
             if match:
                 done = True
                 self.port = int(match.group(1))
-                os.environ['JTAG_VPI_PORT'] = str(self.port)
+                session().env['JTAG_VPI_PORT'] = str(self.port)
 
             if (time.time() - start) > timeout:
                 raise Exception("Timed out waiting for VCS to listen for JTAG "
@@ -280,12 +448,14 @@ class VcsSim:
             pass
 
 class Openocd:
-    logfile = tempfile.NamedTemporaryFile(prefix='openocd', suffix='.log')
-    logname = logfile.name
-
     def __init__(self, server_cmd=None, config=None, debug=False, timeout=60,
                  freertos=False):
         self.timeout = timeout
+        # Every instance gets its own log, so that several OpenOCD processes
+        # can run at the same time.
+        self.logfile = tempfile.NamedTemporaryFile(prefix='openocd',
+                suffix='.log')
+        self.logname = self.logfile.name
 
         if server_cmd:
             cmd = shlex.split(server_cmd)
@@ -310,7 +480,7 @@ class Openocd:
         ]
 
         if config:
-            self.config_file = find_file(config)
+            self.config_file = harness.find_file(config)
             if self.config_file is None:
                 print("Unable to read file", config)
                 sys.exit(1)
@@ -325,20 +495,20 @@ class Openocd:
         else:
             extra_env['USE_FREERTOS'] = "0"
 
-        raw_logfile = open(Openocd.logname, "wb")
+        raw_logfile = open(self.logname, "wb")
         try:
             spike_dasm = subprocess.Popen("spike-dasm", stdin=subprocess.PIPE,
                     stdout=raw_logfile, stderr=raw_logfile)
             logfile = spike_dasm.stdin
         except FileNotFoundError:
             logfile = raw_logfile
-        if print_log_names:
-            real_stdout.write("Temporary OpenOCD log: %s\n" % Openocd.logname)
+        session().log_name("OpenOCD", self.logname)
+        env = session().environ()
         env_entries = ("REMOTE_BITBANG_HOST", "REMOTE_BITBANG_PORT",
                 "WORK_AREA")
-        env_entries = [key for key in env_entries if key in os.environ]
+        env_entries = [key for key in env_entries if key in env]
         parts = [
-            " ".join("%s=%s" % (key, os.environ[key]) for key in env_entries),
+            " ".join("%s=%s" % (key, env[key]) for key in env_entries),
             " ".join("%s=%s" % (k, v) for k, v in extra_env.items()),
             " ".join(map(pipes.quote, cmd))
         ]
@@ -349,7 +519,7 @@ class Openocd:
         self.process = self.start(cmd, logfile, extra_env)
 
     def start(self, cmd, logfile, extra_env):
-        combined_env = {**os.environ, **extra_env}
+        combined_env = {**session().environ(), **extra_env}
         process = subprocess.Popen(cmd, stdin=subprocess.PIPE,
                 stdout=logfile, stderr=logfile, env=combined_env)
 
@@ -360,7 +530,7 @@ class Openocd:
             # attempt too early.
             start = time.time()
             messaged = False
-            fd = open(Openocd.logname, "r")
+            fd = open(self.logname, "r")
             while True:
                 line = fd.readline()
                 if not line:
@@ -385,7 +555,7 @@ class Openocd:
                             "listen for gdb")
 
         except Exception:
-            print_log(Openocd.logname)
+            print_log(self.logname)
             raise
 
     def __del__(self):
@@ -560,6 +730,21 @@ class Gdb:
             11, 149, 107, 163, 73, 47, 43, 173, 7, 109, 101, 103, 191, 2, 139,
             97, 193, 157, 3, 29, 79, 113, 5, 89, 19, 37, 71, 179, 59, 137, 53)
 
+    # Commands that leave something behind in gdb or OpenOCD that
+    # GdbTest.reuse() doesn't undo, like another symbol file or `riscv
+    # memory_sample` slots.
+    lasting_commands = re.compile(r"\s*(file|symbol-file|add-symbol-file|"
+            r"monitor\s+(?!reset\b|riscv\s+(info|dump_sample_buf|repeat_read|"
+            r"reset_delays)\b))")
+    # `set <setting> <value>`, but not `set var`, or assignments to registers
+    # or memory.
+    setting_command = re.compile(r"\s*set\s+(?!var\b|variable\b)"
+            r"([a-z][\w-]*(?:\s+[a-z][\w-]*)*)\s+([^=\s]+)\s*$")
+    setting_aliases = {"arch": "architecture"}
+    # What settings that Gdb doesn't set itself are when gdb starts, for the
+    # ones tests are known to change.
+    setting_defaults = {"architecture": "auto", "can-use-hw-watchpoints": "1"}
+
     def __init__(self, target, ports, cmd=None, timeout=60, binaries=None):
         assert ports
 
@@ -572,6 +757,17 @@ class Gdb:
         self.reset_delay_index = 0
         self.stack = []
         self.harts = {}
+        # Whether the test using this gdb loaded the program, and whether an
+        # earlier test did (see load()).
+        self.loaded = False
+        self.loaded_before = False
+        # Whether a command in lasting_commands was sent since this was last
+        # cleared.
+        self.changed = False
+        # The last value each setting was given, by (child, setting), and
+        # what they were when settle() was called.
+        self.settings = {}
+        self.settled = {}
 
         self.logfiles = []
         self.children = []
@@ -579,9 +775,9 @@ class Gdb:
             logfile = tempfile.NamedTemporaryFile(prefix="gdb@%d-" % port,
                     suffix=".log")
             self.logfiles.append(logfile)
-            if print_log_names:
-                real_stdout.write("Temporary gdb log: %s\n" % logfile.name)
+            session().log_name("gdb", logfile.name)
             child = pexpect.spawn(self.cmd)
+            session().started("gdb", child.pid)
             child.logfile = logfile
             child.logfile.write(("+ %s\n" % self.cmd).encode())
             self.children.append(child)
@@ -675,6 +871,13 @@ class Gdb:
                         len(self.reset_delays)
             self.command("monitor riscv reset_delays %d" % reset_delays,
                     reset_delays=None)
+        if self.lasting_commands.match(command):
+            self.changed = True
+        m = self.setting_command.match(command)
+        if m:
+            name = " ".join(m.group(1).split())
+            name = self.setting_aliases.get(name, name)
+            self.settings[(self.active_child, name)] = m.group(2)
         timeout = max(1, ops) * self.timeout
         self.active_child.sendline(command)
         self.active_child.expect("\n", timeout=timeout)
@@ -685,8 +888,9 @@ class Gdb:
         """Call this from a test at a point where you just want to interact with
         gdb directly. This is useful when you're debugging a problem and just
         want to take over at a certain point in the test."""
-        saved_stdout = sys.stdout
-        sys.stdout = real_stdout
+        current = session()
+        saved_stdout = current.stdout
+        current.stdout = current.real_stdout
         try:
             print()
             print("Interact with the gdb instance created by the test.")
@@ -696,7 +900,7 @@ class Gdb:
                 command = input("(gdb) ")
                 print(self.command(command))
         finally:
-            sys.stdout = saved_stdout
+            current.stdout = saved_stdout
 
 
     def global_command(self, command):
@@ -827,13 +1031,45 @@ class Gdb:
         output = self.command("stepi", ops=10)
         return output
 
+    def settle(self):
+        """Take the current state of gdb as the one every test that uses it
+        starts in."""
+        self.changed = False
+        self.settled = dict(self.settings)
+
+    def restore(self):
+        """Undo the settings tests changed since settle(), and delete their
+        breakpoints. Return False if a setting couldn't be undone."""
+        with PrivateState(self):
+            for (child, name), value in list(self.settings.items()):
+                original = self.settled.get((child, name),
+                        self.setting_defaults.get(name))
+                if value == original:
+                    continue
+                if original is None:
+                    return False
+                self.select_child(child)
+                self.command(f"set {name} {original}", reset_delays=None)
+        self.global_command("delete")
+        return True
+
     def load(self):
+        if self.loaded_before and not self.loaded:
+            # An earlier test that used this gdb (see --share-stacks) loaded
+            # the program, and it might still be intact. Only the first load()
+            # of a test may rely on that.
+            self.loaded = True
+            output = self.system_command("compare-sections", ops=1000)
+            if "matched" in output and "MIS" not in output:
+                self.global_command("set $pc=_start")
+                return
         output = self.system_command("load", ops=1000)
         assert "failed" not in  output
         assert "Transfer rate" in output
         output = self.system_command("compare-sections", ops=1000)
         assert "matched" in output
         assert "MIS" not in output
+        self.loaded = True
 
     def b(self, location):
         output = self.command("b %s" % location, ops=5)
@@ -893,19 +1129,143 @@ class PrivateState:
     def __exit__(self, _type, _value, _traceback):
         self.gdb.pop_state()
 
-def run_all_tests(module, target, parsed):
-    todo = []
-    for name in dir(module):
-        definition = getattr(module, name)
-        if isinstance(definition, type) and hasattr(definition, 'test') and \
-                (not parsed.test or any(test in name for test in parsed.test)):
-            todo.append((name, definition, None))
+def run_all_tests(module, target, parsed, stack_session=None):
+    if parsed.watch:
+        return watch_tests(module, target, parsed)
+
+    todo, selected = select_tests(module, target, parsed)
 
     if parsed.list_tests:
-        for name, definition, hart in todo:
+        for name, _, _ in todo:
             print(name)
         return 0
 
+    if parsed.shard:
+        print(f"Shard {parsed.shard[0] + 1}/{parsed.shard[1]}: "
+                f"{len(todo)} of {selected} tests")
+
+    overall_start = time.time()
+
+    report = run_target(parsed, target, todo, stack_session)
+
+    if report.cached:
+        header(f"ran {report.count} tests ({report.cached} results from "
+                f"cache) in {time.time() - overall_start:.0f}s", dash=':')
+    else:
+        header(f"ran {report.count} tests in "
+                f"{time.time() - overall_start:.0f}s", dash=':')
+
+    if parsed.results:
+        write_results(parsed.results, type(target).__name__, report.results)
+
+    if parsed.repeat > 1:
+        print_repeat_summary(report.runs)
+
+    return print_results(report.results)
+
+def watch_tests(module, target, parsed):
+    """Run the selected tests, and then, whenever a file they depend on
+    changes, run the ones whose inputs (see fingerprint.py) changed. Stop when
+    interrupted. The target is only examined once, and the file the tests are
+    in is reloaded after every change.
+
+    Tests share stacks as with --share-stacks, and the stack the last test
+    left is kept for the next run, as long as only the tests changed. When
+    anything else did, eg. a program, the next run starts from scratch,
+    because reusing a stack doesn't compile or load programs again."""
+    parsed = copy.copy(parsed)
+    parsed.share_stacks = True
+    warm = Session.from_parsed(parsed)
+    warm.keep_stack = True
+    todo, _ = select_tests(module, target, parsed)
+    fingerprints = {}
+    result = 0
+    try:
+        while True:
+            if todo:
+                start = time.time()
+                report = run_target(parsed, target, todo, warm)
+                header(f"ran {report.count} tests in "
+                        f"{time.time() - start:.0f}s", dash=':')
+                result = print_results(report.results)
+
+            # Only now, because ExamineTarget may have changed misa, which is
+            # part of every test's inputs.
+            fingerprinter = fingerprint.Fingerprinter(parsed, target)
+            paths = set((os.path.abspath(module.__file__),
+                os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    "programs")))
+            for name, definition, _ in select_tests(module, target, parsed)[0]:
+                fingerprints[name] = fingerprinter.fingerprint(definition)
+                paths.update(fingerprinter.files(definition))
+            stamps = modification_times(paths)
+            print(f"Watching {len(paths)} files for changes.")
+            sys.stdout.flush()
+            while modification_times(paths) == stamps:
+                time.sleep(1)
+            current = modification_times(paths)
+            if any(current[path] != stamps[path] for path in paths
+                    if os.path.realpath(path) !=
+                    os.path.realpath(module.__file__)):
+                warm.drop_stack()
+
+            module = load_module(module.__file__)
+            BaseTest.compiled.clear()
+            fingerprinter = fingerprint.Fingerprinter(parsed, target)
+            todo = [entry for entry in select_tests(module, target, parsed)[0]
+                    if fingerprinter.fingerprint(entry[1]) !=
+                    fingerprints.get(entry[0])]
+            if not todo:
+                print("No tests are affected by the change.")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        warm.drop_stack()
+    return result
+
+def modification_times(paths):
+    times = {}
+    for path in paths:
+        try:
+            times[path] = os.path.getmtime(path)
+        except OSError:
+            times[path] = None
+    return times
+
+def load_module(path):
+    """Load the Python file at path as a new module, even if it was loaded
+    before."""
+    name = os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    # inspect finds the source of classes through sys.modules.
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def select_tests(module, target, parsed):
+    """Return the tests in module that were selected on the command line and
+    belong to this shard, and how many were selected before sharding."""
+    todo = []
+    for name in dir(module):
+        definition = getattr(module, name)
+        if isinstance(definition, type) and hasattr(definition, 'test') and \
+                not definition.__dict__.get('variants'):
+            if getattr(definition, 'opt_in', False):
+                selected = name in (parsed.test or ())
+            else:
+                selected = not parsed.test or \
+                        any(test in name for test in parsed.test)
+            if selected:
+                todo.append((name, definition, None))
+
+    selected = len(todo)
+    return shard_tests(parsed, target, todo), selected
+
+def run_target(parsed, target, todo, stack_session=None):
+    """Run the tests in todo against target, examining the target first if
+    necessary. Return the Report. The tests run in stack_session, if given,
+    which may hold on to a stack from one call to the next."""
     try:
         os.makedirs(parsed.logs)
     except OSError:
@@ -913,12 +1273,13 @@ def run_all_tests(module, target, parsed):
         # decide to create the logs directory at the same time.
         pass
 
-    overall_start = time.time()
+    over_budget = []
+    if parsed.time_budget is not None:
+        todo, over_budget = budget_tests(parsed, target, todo)
 
-    global gdb_cmd  # pylint: disable=global-statement
-    gdb_cmd = parsed.gdb
-    global gcc_cmd  # pylint: disable=global-statement
-    gcc_cmd = parsed.gcc
+    todo = [entry for entry in todo for _ in range(parsed.repeat)]
+    todo = order_tests(parsed, target, todo)
+    todo = group_tests(todo, parsed.share_stacks)
 
     examine_added = False
     for hart in target.harts:
@@ -931,51 +1292,1082 @@ def run_all_tests(module, target, parsed):
             todo.insert(0, ("ExamineTarget", ExamineTarget, None))
             examine_added = True
 
-    results, count = run_tests(parsed, target, todo)
-
-    header("ran %d tests in %.0fs" % (count, time.time() - overall_start),
-            dash=':')
+    with stack_session or Session.from_parsed(parsed):
+        report = run_tests(parsed, target, todo)
+    for name in over_budget:
+        report.results.setdefault("over_budget", []).append((name, None))
+    return report
+
+def changed_tests(parsed, target, todo, hist):
+    """Return the names of tests in todo that never ran on target, or that
+    depend on a file (see fingerprint.py) that changed since they last
+    ran."""
+    fingerprinter = fingerprint.Fingerprinter(parsed, target)
+    mtimes = {}
+    changed = set()
+    for name, definition, _ in todo:
+        runs = hist.recent(type(target).__name__, name)
+        if not runs:
+            changed.add(name)
+            continue
+        for path in fingerprinter.files(definition):
+            if path not in mtimes:
+                try:
+                    mtimes[path] = os.path.getmtime(path)
+                except OSError:
+                    mtimes[path] = 0
+            if mtimes[path] > runs[-1].when:
+                changed.add(name)
+                break
+    return changed
+
+def budget_tests(parsed, target, todo):
+    """Return the part of todo that is expected to fit in --time-budget, and
+    the names of the tests that were left out."""
+    hist = history.load(parsed.history, parsed.logs)
+    names = [name for name, _, _ in todo]
+    # Tests run parsed.repeat times, parsed.jobs at a time.
+    seconds = parsed.time_budget * max(parsed.jobs, 1) / parsed.repeat
+    chosen, skipped = history.budget(hist, type(target).__name__, names,
+            seconds, changed_tests(parsed, target, todo, hist))
+    if skipped:
+        print(f"Time budget: running {len(chosen)} of {len(names)} tests, "
+                f"leaving out {' '.join(skipped)}")
+    chosen = set(chosen)
+    return [entry for entry in todo if entry[0] in chosen], skipped
+
+def order_tests(parsed, target, todo):
+    """Reorder todo according to --order and --failures-first, using the
+    results of earlier runs."""
+    if parsed.order == "name" and not parsed.failures_first:
+        return todo
+    hist = history.load(parsed.history, parsed.logs)
+    names = history.order(hist, type(target).__name__,
+            [name for name, _, _ in todo],
+            longest_first=parsed.order == "longest",
+            failures_first=parsed.failures_first)
+    position = {name: i for i, name in enumerate(names)}
+    return sorted(todo, key=lambda entry: position[entry[0]])
+
+def group_tests(todo, share_stacks):
+    """Reorder todo so that variants of the same test are next to each other,
+    so they can share a stack, as are (with share_stacks) tests that compile
+    the same program and set up the same way, which can too. Groups are
+    ordered by where their first test was."""
+    def key(definition):
+        if share_stacks:
+            return (getattr(definition, 'compile_args', None),
+                    definition.classSetup, definition.setup)
+        return definition.variant_of or definition
+    first = {}
+    for i, (_, definition, _) in enumerate(todo):
+        first.setdefault(key(definition), i)
+    return sorted(todo, key=lambda entry: first[key(entry[1])])
+
+def shard_tests(parsed, target, todo):
+    """Return the part of todo that belongs to the shard selected with
+    --shard."""
+    if not parsed.shard:
+        return todo
+    index, count = parsed.shard
+    # The history database changes as shards finish tests, so balancing by it
+    # would give every shard a different split. Use a fixed snapshot instead.
+    if parsed.shard_timings:
+        hist = history.History.from_timings(parsed.shard_timings)
+    else:
+        hist = history.History()
+    names = set(history.shard(hist, type(target).__name__,
+            [name for name, _, _ in todo], index, count))
+    return [entry for entry in todo if entry[0] in names]
+
+def parse_shard(text):
+    """Parse the argument of --shard, which is i/N with i counting from 1."""
+    m = re.match(r"^(\d+)/(\d+)$", text)
+    if not m or not 1 <= int(m.group(1)) <= int(m.group(2)):
+        raise argparse.ArgumentTypeError(
+                f"expected i/N with 1 <= i <= N, got {text!r}")
+    return int(m.group(1)) - 1, int(m.group(2))
+
+def write_results(path, target_name, results):
+    with open(path, "w", encoding="utf-8") as fd:
+        json.dump({"target": target_name, "results": results}, fd, indent=2)
+
+def read_results(paths):
+    """Merge results files written by --results into one results dict, as
+    print_results() takes."""
+    results = {}
+    for path in paths:
+        with open(path, encoding="utf-8") as fd:
+            for key, value in json.load(fd)["results"].items():
+                results.setdefault(key, []).extend(tuple(v) for v in value)
+    return results
+
+# flaky and quarantined are reported with their logs, but don't fail the run.
+# over_budget tests weren't run at all because of --time-budget.
+good_results = set(('pass', 'not_applicable', 'cached-pass', 'flaky',
+    'quarantined', 'over_budget'))
+# Results that are retried with --retries, since they usually mean the
+# simulator, server or gdb fell over rather than that the test found a bug.
+retry_results = set(('exception', 'timeout'))
+def run_tests(parsed, target, todo):
+    report = Report(parsed, target)
+    # Tests that might have to be killed are run in a worker process, even
+    # without --jobs.
+    if parsed.jobs > 1 or parsed.workers or parsed.fork or \
+            Watchdog(parsed, target).enabled:
+        run_tests_parallel(parsed, target, todo, report)
+        return report
+
+    # Tests that were already reported before they ran.
+    reported = None
+    prefetcher = Prefetcher(parsed, target) if parsed.prefetch else None
+    try:
+        for index, (_, definition, _) in enumerate(todo):
+            if definition is not ExamineTarget:
+                # ExamineTarget, which is always first, has filled in misa
+                # now.
+                if reported is None:
+                    reported = report_unrun(parsed, target, todo, index,
+                            report)
+                if index in reported:
+                    continue
+            prefetched = None
+            if prefetcher:
+                prefetched = prefetcher.take(index)
+                if definition is not ExamineTarget:
+                    prefetcher.start_after(todo, index, reported)
+            # The prefetched stack lives in its own session. The stack the
+            # test leaves behind (see --share-stacks) is handed back to the
+            # session the tests share, because the prefetched one drops it.
+            shared = session()
+            with prefetched or contextlib.nullcontext():
+                result = run_and_report(parsed, target, todo, index, report)
+                if prefetched and prefetched.stack:
+                    shared.stack = prefetched.take_stack()
+            if result not in good_results and parsed.fail_fast:
+                break
+    finally:
+        if prefetcher:
+            prefetcher.take(None)
+
+    return report
+
+def report_unrun(parsed, target, todo, index, report):
+    """Report the tests from todo[index] on that won't run, because they don't
+    apply (with --preflight), passed before (with --cache) or their program
+    doesn't build, like run_tests_parallel() does. Return their indices."""
+    reported, checks = set(), None
+    if parsed.preflight:
+        reported, checks = preflight(parsed, target, todo, report)
+    pending = [i for i in range(index, len(todo)) if i not in reported]
+    reported |= {i for i in pending if report.from_cache(*todo[i][:2])}
+    reported |= build_programs(parsed, target, todo,
+            [i for i in pending if i not in reported], report, checks=checks)
+    return reported
+
+def run_and_report(parsed, target, todo, index, report):
+    """Run the test at todo[index], and again as long as --retries says to.
+    Return what it was reported as."""
+    name, definition, hart = todo[index]
+    result = None
+    while result is None:
+        result = report.add(name, *run_test(parsed, target, name, definition,
+            hart, iteration=repetition(todo, index)),
+            iteration=repetition(todo, index))
+    return result
 
-    return print_results(results)
+class Prefetcher:
+    """Gets the next test ready while the current one runs (see --prefetch),
+    by compiling its program on a thread, and with --prefetch stack also
+    starting its simulator, server and gdb. The stack is set up in a Session
+    of its own, which the test then runs in."""
+    def __init__(self, parsed, target):
+        self.parsed = parsed
+        self.target = target
+        self.thread = None
+        self.index = None
+        self.session = None
+        # Threads only print through their own (captured) session.
+        if not isinstance(sys.stdout, SessionStdout):
+            sys.stdout = SessionStdout(sys.stdout)
+
+    def start_after(self, todo, index, reported):
+        """Start on the next test after todo[index] that (as far as we know
+        now) will run, ie. that isn't in reported."""
+        following = [i for i in range(index + 1, len(todo))
+                if i not in reported]
+        if following:
+            self.start(todo, following[0])
+
+    def start(self, todo, index):
+        _, definition, hart = todo[index]
+        self.index = index
+        self.session = Session.from_parsed(self.parsed)
+        self.thread = threading.Thread(target=self.prefetch,
+                args=(definition, hart), daemon=True)
+        self.thread.start()
+
+    def prefetch(self, definition, hart):
+        # Not "with self.session", which would shut the stack down again as
+        # soon as it's up.
+        Session.local.session = self.session
+        output = io.StringIO()
+        self.session.capture(output)
+        try:
+            instance = definition(self.target, hart)
+            if self.parsed.prefetch == "stack" and \
+                    instance.stack_key() is not None and \
+                    definition.__name__ not in self.target.skip_tests and \
+                    instance.early_applicable():
+                instance.classSetup()
+                stack = Stack(instance)
+                stack.prefetched = True
+                self.session.stack = stack
+            else:
+                instance.compile()
+        except Exception:   # pylint: disable=broad-except
+            # The test runs into the same problem when it does this itself,
+            # and reports it properly.
+            traceback.print_exc(file=output)
+        finally:
+            self.session.release()
+            if self.session.stack:
+                self.session.stack.output = output.getvalue()
+
+    def take(self, index):
+        """Wait for the current prefetch to finish. Return the Session the
+        stack it started is in, if it was for todo[index] and did start
+        one."""
+        if not self.thread:
+            return None
+        self.thread.join()
+        self.thread = None
+        if index == self.index and self.session.stack:
+            return self.session
+        self.session.drop_stack()
+        return None
+
+def test_log_name(parsed, target, name):
+    """Return the name of a new log file for test name. The file is created,
+    so that the name isn't handed out twice: a retried or repeated test can
+    start more than once within the same second."""
+    base = os.path.join(parsed.logs,
+            f"{time.strftime('%Y%m%d-%H%M%S')}-{type(target).__name__}-{name}")
+    log_name = base + ".log"
+    attempt = 2
+    while True:
+        try:
+            os.close(os.open(log_name, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return log_name
+        except FileExistsError:
+            log_name = f"{base}-{attempt}.log"
+            attempt += 1
+
+def repetition(todo, index):
+    """Return how many times the test at todo[index] appears before it, which
+    is only ever non-zero with --repeat."""
+    name = todo[index][0]
+    return sum(1 for entry in todo[:index] if entry[0] == name)
+
+def run_test(parsed, target, name, definition, hart, *, log_name=None,
+        iteration=0):
+    """Run a single test, with all of its output going to its own log file.
+    Return a tuple of the result, the log file name, and the time it took."""
+    log_name = log_name or test_log_name(parsed, target, name)
+    # Line buffered, so that the log is complete up to the last line even if
+    # the test is killed.
+    log_fd = open(log_name, 'w', buffering=1, encoding='utf-8')
+    print("[%s] Starting > %s" % (name, log_name))
+    stack = session().stack
+    if hart is None and stack and stack.usable_by(definition,
+            parsed.share_stacks):
+        # Tests on other harts couldn't use the stack.
+        hart = stack.hart
+    instance = definition(target, hart)
+    instance.reset_delay_start = iteration
+    instance.share_stack = parsed.share_stacks
+    sys.stdout.flush()
+    log_fd.write("Test: %s\n" % name)
+    log_fd.write("Target: %s\n" % type(target).__name__)
+    log_fd.write("Hart: %s\n" % instance.hart.name)
+    start = time.time()
+    session().capture(log_fd)
+    try:
+        result = instance.run()
+        log_fd.write("Result: %s\n" % result)
+        phases = " ".join(f"{name}={seconds:.2f}"
+                for name, seconds in instance.phases.items())
+        log_fd.write(f"Phases: {phases}\n")
+        log_fd.write("Logfile: %s\n" % log_name)
+        log_fd.write("Reproduce: %s %s %s\n" % (sys.argv[0], parsed.target,
+            name))
+    finally:
+        session().release()
+        log_fd.write("Time elapsed: %.2fs\n" % (time.time() - start))
+        log_fd.flush()
+    return result, log_name, time.time() - start
+
+class Report:
+    """Collects results as tests finish, prints them, and records them in the
+    history database.
+
+    With --cache, it also answers whether a test can be skipped because it
+    passed before with exactly the same inputs."""
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, parsed, target):
+        self.parsed = parsed
+        self.target_name = type(target).__name__
+        self.results = {}
+        self.count = 0
+        self.cached = 0
+        self.database = None
+        if parsed.history != "none":
+            self.database = history.Database(
+                    parsed.history or history.default_path(parsed.logs))
+        self.writers = resultstream.open_writers(parsed)
+        self.attempts = collections.Counter()
+        # (name, result, elapsed) of every test, in the order they finished.
+        self.runs = []
+        self.quarantined = set()
+        if parsed.quarantine is not None:
+            self.quarantined = set(history.quarantine(
+                history.load(parsed.history, parsed.logs), self.target_name,
+                parsed.quarantine))
+            if self.quarantined:
+                print(f"Quarantined: {' '.join(sorted(self.quarantined))}")
+        self.fingerprinter = None
+        self.inputs = {}
+        if parsed.cache and self.database:
+            self.fingerprinter = fingerprint.Fingerprinter(parsed, target)
+
+    def from_cache(self, name, definition):
+        """Return True, after reporting a cached pass, if the test passed
+        earlier with the same inputs it has now."""
+        if not self.fingerprinter or definition is ExamineTarget or \
+                self.parsed.repeat > 1:
+            # ExamineTarget collects information that other tests need, so it
+            # always has to run.
+            return False
+        inputs = self.fingerprinter.fingerprint(definition)
+        self.inputs[name] = inputs
+        if self.parsed.rerun:
+            return False
+        log_name = self.database.passed(self.target_name, name, inputs)
+        if log_name is None:
+            return False
+        self.cached += 1
+        self.add(name, "cached-pass", log_name, 0)
+        return True
 
-good_results = set(('pass', 'not_applicable'))
-def run_tests(parsed, target, todo):
-    results = {}
-    count = 0
-
-    for name, definition, hart in todo:
-        log_name = os.path.join(parsed.logs, "%s-%s-%s.log" %
-                (time.strftime("%Y%m%d-%H%M%S"), type(target).__name__, name))
-        log_fd = open(log_name, 'w')
-        print("[%s] Starting > %s" % (name, log_name))
-        instance = definition(target, hart)
+    def add(self, name, result, log_name, elapsed, *, retry=True, iteration=0):
+        """Report that test name finished. Return the result it's reported
+        as, which is different from result for flaky and quarantined tests,
+        or None if it should be run again because of --retries (unless retry
+        is False). With --repeat, every repetition of a test gets its own
+        retries."""
+        run = None
+        if log_name and result != "cached-pass":
+            try:
+                run = history.parse_log(log_name)
+            except OSError:
+                pass
+        phases = run.phases if run else {}
+        # The database gets the outcome of every attempt, so that flake rates
+        # can be computed from it.
+        if self.database and result != "cached-pass":
+            self.database.record(self.target_name, name, result, elapsed,
+                    log_name=log_name, inputs=self.inputs.get(name),
+                    phases=phases)
+
+        attempt = (name, iteration)
+        if retry and result in retry_results and \
+                self.attempts[attempt] < self.parsed.retries:
+            self.attempts[attempt] += 1
+            print(f"[{name}] {result} in {elapsed:.2f}s, retrying "
+                    f"({self.attempts[attempt]}/{self.parsed.retries}) > "
+                    f"{log_name}")
+            sys.stdout.flush()
+            return None
+
+        reported = result
+        if self.attempts[attempt] and result in good_results:
+            reported = "flaky"
+        elif result not in good_results and name in self.quarantined:
+            reported = "quarantined"
+        if reported == result:
+            print(f"[{name}] {result} in {elapsed:.2f}s")
+        else:
+            print(f"[{name}] {reported} ({result}) in {elapsed:.2f}s")
+        if reported not in good_results and self.parsed.print_failures and \
+                log_name:
+            sys.stdout.write(open(log_name).read())
         sys.stdout.flush()
-        log_fd.write("Test: %s\n" % name)
-        log_fd.write("Target: %s\n" % type(target).__name__)
-        start = time.time()
-        global real_stdout  # pylint: disable=global-statement
-        real_stdout = sys.stdout
-        sys.stdout = log_fd
+        self.results.setdefault(reported, []).append((name, log_name))
+        self.runs.append((name, reported, elapsed))
+        self.count += 1
+
+        for writer in self.writers:
+            writer.add(resultstream.record(target=self.target_name,
+                test=name, hart=run.hart if run else None, result=reported,
+                elapsed=elapsed, phases=phases, log_name=log_name))
+        return reported
+
+class Watchdog:
+    """Decides how long each test may run before it's killed, according to
+    --timeout or the target's test_timeout_sec. Only tests that run in worker
+    processes can be killed."""
+    # With --timeout auto, a test may take this many times as long as it
+    # usually does, but at least minimum seconds.
+    factor = 5
+    minimum = 60
+
+    def __init__(self, parsed, target):
+        self.target_name = type(target).__name__
+        self.default = target.test_timeout_sec
+        self.history = None
+        if parsed.timeout == "auto":
+            self.history = history.load(parsed.history, parsed.logs)
+        elif parsed.timeout:
+            self.default = parsed.timeout
+        self.enabled = bool(self.default or self.history) and \
+                not parsed.threads
+
+    def budget(self, name):
+        """Return how many seconds test name may take, or None if there's no
+        limit."""
+        if self.history:
+            expected = self.history.expected_duration(self.target_name, name)
+            if expected is not None:
+                return max(self.minimum, self.factor * expected)
+        return self.default
+
+def parse_timeout(text):
+    if text == "auto":
+        return text
+    try:
+        return float(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(
+                f"expected a number of seconds or 'auto', got {text!r}") from e
+
+def kill_started(log_name):
+    """Kill the processes that the test with log_name noted with
+    Session.started(), which killing its process group doesn't reach."""
+    with open(log_name, encoding="utf-8", errors="ignore") as fd:
+        pids = re.findall(r"^Started \S+ process: (\d+)$", fd.read(),
+                re.MULTILINE)
+    for pid in pids:
+        try:
+            os.kill(int(pid), signal.SIGKILL)
+        except OSError:
+            pass
+
+def collect_partial_logs(log_name, elapsed):
+    """Finish the log of a test that was killed: copy in the temporary logs of
+    the processes it started, which it didn't get to do itself, and add the
+    result lines that history.parse_log() looks for."""
+    with open(log_name, encoding="utf-8", errors="ignore") as fd:
+        names = re.findall(r"^Temporary \S+ log: (\S+)$", fd.read(),
+                re.MULTILINE)
+    with open(log_name, "a", encoding="utf-8") as fd:
+        with contextlib.redirect_stdout(fd):
+            for name in names:
+                try:
+                    print_log(name)
+                    os.unlink(name)
+                except OSError:
+                    pass
+        fd.write("Result: timeout\n")
+        fd.write(f"Time elapsed: {elapsed:.2f}s\n")
+
+class TestWorker:
+    """A forked process that runs tests from the todo list, one at a time, as
+    the parent sends it their indices. Every test it runs still creates its own
+    simulator/server/gdb stack.
+
+    The worker puts itself in its own process group, so that killing that group
+    also takes down any simulator or server that a test left running."""
+    def __init__(self, context, parsed, target, todo):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=self.main,
+                args=(child_connection, parsed, target, todo))
+        self.process.start()
+        child_connection.close()
+        self.index = None
+        self.log_name = None
+        self.alive = True
+        self.started = None
+        self.deadline = None
+
+    @staticmethod
+    def main(connection, parsed, target, todo):
+        os.setpgrp()
+        # Don't let every worker pick the same random harts.
+        random.seed()
+        # A session of its own, so that the worker doesn't use (or shut down)
+        # a stack that the parent's session is keeping (see daemon.py).
+        with Session.from_parsed(parsed):
+            while True:
+                task = connection.recv()
+                if task is None:
+                    return
+                index, log_name = task
+                name, definition, hart = todo[index]
+                connection.send(run_test(parsed, target, name, definition,
+                    hart, log_name=log_name,
+                    iteration=repetition(todo, index)))
+
+    def send(self, index, log_name, budget=None):
+        self.index = index
+        self.log_name = log_name
+        self.started = time.time()
+        self.deadline = self.started + budget if budget else None
+        self.connection.send((index, log_name))
+
+    def receive(self):
+        """Return the result of the test that was last sent. If the worker
+        died before it could report back, that test counts as an
+        exception."""
+        self.index = None
+        try:
+            return self.connection.recv()
+        except (EOFError, OSError):
+            self.alive = False
+            return "exception", self.log_name, 0
+
+    def time_out(self):
+        """Kill the worker, and everything the test started, because the
+        test ran out of time."""
+        self.index = None
+        self.alive = False
+        kill_started(self.log_name)
+        self.kill()
+        elapsed = time.time() - self.started
+        collect_partial_logs(self.log_name, elapsed)
+        return "timeout", self.log_name, elapsed
+
+    def finished(self, ready):
+        """Return the result of the test that was last sent if it's done (or
+        out of time) now, given what multiprocessing.connection.wait() found
+        ready, or None if it's still running."""
+        if self.connection in ready or self.process.sentinel in ready:
+            return self.receive()
+        if self.deadline and time.time() >= self.deadline:
+            return self.time_out()
+        return None
+
+    def stop(self):
+        if self.alive:
+            try:
+                self.connection.send(None)
+            except OSError:
+                pass
+            self.process.join(10)
+        self.kill()
+
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.process.join()
+
+def run_tests_parallel(parsed, target, todo, report):
+    """Run the tests in todo on parsed.jobs workers, which are either processes
+    or threads, or on the remote workers in parsed.workers. Tests that
+    determine properties of the target (ExamineTarget) are run first, by
+    themselves, so that the workers can use what they found."""
+    remote = None
+    if parsed.workers:
+        remote = RemotePool(parsed, target, todo)
+
+    try:
+        serial = [i for i, entry in enumerate(todo)
+                if entry[1] is ExamineTarget]
+        if remote:
+            if not remote.run(serial, report):
+                return
+        else:
+            for index in serial:
+                result = run_and_report(parsed, target, todo, index, report)
+                if result not in good_results and parsed.fail_fast:
+                    return
+
+        inapplicable, checks = set(), None
+        if parsed.preflight:
+            inapplicable, checks = preflight(parsed, target, todo, report)
+
+        # Only look in the cache now that ExamineTarget has filled in misa,
+        # which is part of every test's inputs.
+        pending = [i for i, (name, definition, _) in enumerate(todo)
+                if definition is not ExamineTarget and
+                i not in inapplicable and
+                not report.from_cache(name, definition)]
+
+        if remote:
+            remote.run(pending, report)
+            return
+        # Worker processes forked afterwards find the programs in
+        # BaseTest.compiled, instead of each compiling their own.
+        failed = build_programs(parsed, target, todo, pending, report,
+                checks=checks)
+        pending = [i for i in pending if i not in failed]
+        pending.reverse()
+        if parsed.threads:
+            run_on_threads(parsed, target, todo, pending, report)
+        else:
+            run_on_processes(parsed, target, todo, pending, report)
+    finally:
+        if remote:
+            remote.close()
+
+def applicable(parsed, target, definition, hart):
+    """Return whether definition applies to hart, according to skip_tests and
+    early_applicable(). Anything early_applicable() prints is thrown away. If
+    it raises an exception, the test is assumed to apply, so that it can
+    report the exception itself."""
+    if definition.__name__ in target.skip_tests:
+        return False
+    with Session.from_parsed(parsed), \
+            open(os.devnull, "w", encoding="utf-8") as devnull:
+        session().capture(devnull)
         try:
-            result = instance.run()
-            log_fd.write("Result: %s\n" % result)
-            log_fd.write("Logfile: %s\n" % log_name)
-            log_fd.write("Reproduce: %s %s %s\n" % (sys.argv[0], parsed.target,
-                name))
+            return bool(definition(target, hart).early_applicable())
+        except Exception:   # pylint: disable=broad-except
+            return True
         finally:
-            sys.stdout = real_stdout
-            log_fd.write("Time elapsed: %.2fs\n" % (time.time() - start))
-            log_fd.flush()
-        print("[%s] %s in %.2fs" % (name, result, time.time() - start))
-        if result not in good_results and parsed.print_failures:
-            sys.stdout.write(open(log_name).read())
+            session().release()
+
+def preflight(parsed, target, todo, report):
+    """Find out which tests in todo don't apply to target before running any
+    of them, and report those as not_applicable. Return their indices.
+
+    early_applicable() is evaluated on a thread pool, since some tests compile
+    a program to decide. A test that isn't bound to a hart is only left out if
+    it doesn't apply to any hart. Verdicts are cached in the history database,
+    keyed by the test's inputs (see fingerprint.py), which include the target
+    files, its misa and the toolchain.
+
+    Return the indices of the tests that don't apply, and the verdicts."""
+    checks = verdicts(parsed, target, [(definition, h.index)
+        for _, definition, hart in todo if definition is not ExamineTarget
+        for h in test_harts(target, hart)], report)
+
+    inapplicable = set()
+    for index, (name, definition, hart) in enumerate(todo):
+        if definition is ExamineTarget:
+            continue
+        if not any(checks[(definition, h.index)]
+                for h in test_harts(target, hart)):
+            inapplicable.add(index)
+            report.add(name, "not_applicable", None, 0, retry=False)
+    if inapplicable:
+        print(f"Preflight: {len(inapplicable)} of {len(todo)} tests don't "
+                f"apply to {type(target).__name__}")
         sys.stdout.flush()
-        results.setdefault(result, []).append((name, log_name))
-        count += 1
-        if result not in good_results and parsed.fail_fast:
-            break
+    return inapplicable, checks
+
+def test_harts(target, hart):
+    """Return the harts that a test in a todo list, bound to hart (or None),
+    may run on."""
+    return [hart] if hart else target.harts
+
+def verdicts(parsed, target, keys, report):
+    """Return whether each (definition, hart index) in keys applies, taking
+    the answer from the history database if it has one, and asking
+    applicable() on a thread pool (and recording the answer) otherwise."""
+    checks = dict.fromkeys(keys)
+    database = report.database
+    fingerprinter = None
+    if database:
+        fingerprinter = report.fingerprinter or \
+                fingerprint.Fingerprinter(parsed, target)
+        checks = {(definition, index): database.verdict(
+                    fingerprinter.fingerprint(definition), index)
+                for definition, index in checks}
+
+    unknown = [key for key, verdict in checks.items() if verdict is None]
+    # Threads only print through their own (captured) session.
+    if not isinstance(sys.stdout, SessionStdout):
+        sys.stdout = SessionStdout(sys.stdout)
+    with concurrent.futures.ThreadPoolExecutor(
+            max(parsed.jobs, os.cpu_count() or 1)) as executor:
+        futures = {key: executor.submit(applicable, parsed, target, key[0],
+            target.harts[key[1]]) for key in unknown}
+        for key, future in futures.items():
+            checks[key] = future.result()
+            if database:
+                database.record_verdict(fingerprinter.fingerprint(key[0]),
+                        key[1], checks[key])
+    return checks
+
+def program_key(target, hart, compile_args):
+    """Return the key of the program compile_args builds for hart in
+    BaseTest.compiled. Binaries also depend on the target's link script and
+    number of harts, which matters when one process tests several targets
+    (see batch.py)."""
+    return (compile_args, hart.misa, hart.xlen, hart.link_script_path,
+            len(target.harts))
+
+def compile_program(target, hart, compile_args):
+    """Return the binary compile_args builds for hart, compiling it unless
+    that was done before."""
+    key = program_key(target, hart, compile_args)
+    # Another thread may be compiling the same program (see Prefetcher and
+    # build_programs()).
+    with BaseTest.compiling.setdefault(key, threading.Lock()):
+        if key not in BaseTest.compiled:
+            BaseTest.compiled[key] = target.compile(hart, *compile_args)
+    return BaseTest.compiled[key]
+
+def try_compile(parsed, target, hart, compile_args):
+    """Compile the program compile_args builds for hart, on a thread of
+    build_programs(). Return None, or the output of a failed build."""
+    output = io.StringIO()
+    with Session.from_parsed(parsed):
+        session().capture(output)
+        try:
+            compile_program(target, hart, compile_args)
+            return None
+        except CompileError:
+            # compile() already printed what went wrong.
+            return output.getvalue()
+        except Exception:   # pylint: disable=broad-except
+            traceback.print_exc(file=output)
+            return output.getvalue()
+        finally:
+            session().release()
+
+def compile_programs(parsed, target, programs):
+    """Compile programs, which maps program keys to (hart, compile_args), on a
+    thread pool. Print the compiler's output for programs that fail to build.
+    Return a dict of that output (or None) by program key."""
+    # Threads only print through their own (captured) session.
+    if not isinstance(sys.stdout, SessionStdout):
+        sys.stdout = SessionStdout(sys.stdout)
+    errors = {}
+    with concurrent.futures.ThreadPoolExecutor(
+            max(parsed.jobs, os.cpu_count() or 1)) as executor:
+        futures = {key: executor.submit(try_compile, parsed, target, *program)
+                for key, program in programs.items()}
+        for key, future in futures.items():
+            errors[key] = future.result()
+            if errors[key] is not None:
+                hart, compile_args = programs[key]
+                header(f"Building {' '.join(compile_args)} for {hart.name} "
+                        "failed")
+                print(errors[key])
+    sys.stdout.flush()
+    return errors
+
+def write_unrun_log(parsed, target, name, output, result):
+    """Write a log for test name, which wasn't run because of output, and
+    return its name."""
+    log_name = test_log_name(parsed, target, name)
+    with open(log_name, "w", encoding="utf-8") as log_fd:
+        log_fd.write(f"Test: {name}\n")
+        log_fd.write(f"Target: {type(target).__name__}\n")
+        log_fd.write(output)
+        log_fd.write(f"Result: {result}\n")
+        log_fd.write("Time elapsed: 0.00s\n")
+    return log_name
+
+def test_programs(target, entry):
+    """Return the programs (see compile_programs()) that the test in todo
+    entry needs, by program key."""
+    _, definition, hart = entry
+    compile_args = getattr(definition, 'compile_args', None)
+    if not compile_args:
+        return {}
+    return {program_key(target, h, compile_args): (h, compile_args)
+            for h in test_harts(target, hart)}
+
+def build_programs(parsed, target, todo, indices, report, *, checks=None):
+    """Compile every program the tests at indices need, for the harts they can
+    run on, each one only once, on a thread pool. Print the compiler's output
+    for programs that fail to build, and report the tests that need them (and
+    would otherwise run) as exceptions right away. Return the indices of those
+    tests.
+
+    checks are the verdicts (see verdicts()) preflight() found, if it ran."""
+    programs = {}
+    for index in indices:
+        programs.update(test_programs(target, todo[index]))
+    errors = compile_programs(parsed, target, programs)
+
+    broken = {}
+    for index in indices:
+        output = "".join(errors[key] or ""
+                for key in test_programs(target, todo[index]))
+        if output:
+            broken[index] = output
+    if checks is None:
+        checks = verdicts(parsed, target, [(todo[index][1], h.index)
+            for index in broken for h in test_harts(target, todo[index][2])],
+            report)
+
+    failed = set()
+    for index, output in broken.items():
+        name, definition, hart = todo[index]
+        # A test may decide it doesn't apply because its program doesn't
+        # build (eg. VectorTest), so let it run to say so.
+        if not all(checks[(definition, h.index)]
+                for h in test_harts(target, hart)):
+            continue
+        failed.add(index)
+        report.add(name, "exception",
+                write_unrun_log(parsed, target, name, output, "exception"), 0,
+                retry=False)
+    return failed
+
+def wait_for_workers(busy):
+    """Wait until one of the busy TestWorkers finishes, or runs out of time.
+    Return what multiprocessing.connection.wait() found ready."""
+    deadlines = [worker.deadline for worker in busy if worker.deadline]
+    timeout = None
+    if deadlines:
+        timeout = max(0, min(deadlines) - time.time())
+    return multiprocessing.connection.wait(
+            [worker.connection for worker in busy] +
+            [worker.process.sentinel for worker in busy], timeout)
+
+def run_on_processes(parsed, target, todo, pending, report):
+    sys.stdout.flush()
+    context = multiprocessing.get_context("fork")
+    watchdog = Watchdog(parsed, target)
+    workers = [TestWorker(context, parsed, target, todo)
+            for _ in range(min(parsed.jobs, len(pending)))]
+
+    def send(worker):
+        if not worker.alive:
+            workers.remove(worker)
+            worker.kill()
+            worker = TestWorker(context, parsed, target, todo)
+            workers.append(worker)
+        index = pending.pop()
+        name = todo[index][0]
+        worker.send(index, test_log_name(parsed, target, name),
+                watchdog.budget(name))
 
-    return results, count
+    try:
+        for worker in workers:
+            if pending:
+                send(worker)
+
+        while any(worker.index is not None for worker in workers):
+            busy = [worker for worker in workers if worker.index is not None]
+            ready = wait_for_workers(busy)
+            for worker in busy:
+                index = worker.index
+                finished = worker.finished(ready)
+                if finished is None:
+                    continue
+                result = report.add(todo[index][0], *finished,
+                        iteration=repetition(todo, index))
+                if result is None:
+                    # Retry it next, on a new stack.
+                    pending.append(index)
+                elif result not in good_results and parsed.fail_fast:
+                    return
+                if pending:
+                    send(worker)
+    finally:
+        for worker in workers:
+            if worker.index is None:
+                worker.stop()
+            else:
+                # Still busy, which means we're giving up on the run.
+                worker.kill()
+
+def run_on_threads(parsed, target, todo, pending, report):
+    """Run tests on threads in this process. Every thread gets its own Session,
+    so the stacks don't see each other's ports or output. Threads can't be
+    killed, so with --fail-fast the tests that are already running are allowed
+    to finish, but their results are not reported."""
+    def run_one(index, log_name):
+        name, definition, hart = todo[index]
+        with Session.from_parsed(parsed):
+            return run_test(parsed, target, name, definition, hart,
+                    log_name=log_name, iteration=repetition(todo, index))
+
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(parsed.jobs) as executor:
+        while pending or running:
+            while pending and len(running) < parsed.jobs:
+                index = pending.pop()
+                log_name = test_log_name(parsed, target, todo[index][0])
+                future = executor.submit(run_one, index, log_name)
+                running[future] = (index, log_name)
+            done, _ = concurrent.futures.wait(running,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                index, log_name = running.pop(future)
+                name = todo[index][0]
+                try:
+                    result, log_name, elapsed = future.result()
+                except Exception:    # pylint: disable=broad-except
+                    traceback.print_exc(file=sys.stdout)
+                    result, elapsed = "exception", 0
+                result = report.add(name, result, log_name, elapsed,
+                        iteration=repetition(todo, index))
+                if result is None:
+                    pending.append(index)
+                elif result not in good_results and parsed.fail_fast:
+                    pending.clear()
+                    running.clear()
+                    return
+
+def worker_argv(parsed):
+    """Return the command line a worker should use to instantiate the same
+    target we're testing."""
+    argv = [harness.relative_to_harness(parsed.target), "--sim_cmd",
+            parsed.sim_cmd]
+    if parsed.server_cmd:
+        argv += ["--server_cmd", parsed.server_cmd]
+    if parsed.xlen:
+        argv.append(f"--{parsed.xlen}")
+    if parsed.gcc:
+        argv += ["--gcc", parsed.gcc]
+    if parsed.gdb:
+        argv += ["--gdb", parsed.gdb]
+    return argv
+
+class RemotePool:
+    """Runs tests on agents started with worker.py, which may be on other
+    machines. Every address in parsed.workers is one connection, which runs one
+    test at a time, so list an agent more than once to run several tests on it
+    at the same time.
+
+    A worker that goes away has its test re-queued on the others."""
+    # pylint: disable=too-many-instance-attributes
+    # Give up on a test after it lost this many workers, in case it's the test
+    # that kills them.
+    max_attempts = 3
+    # Workers send a heartbeat while a test runs. One that's silent for this
+    # long is considered dead.
+    silence_timeout = 120
+
+    def __init__(self, parsed, target, todo):
+        self.parsed = parsed
+        self.target = target
+        self.todo = todo
+        self.argv = worker_argv(parsed)
+        self.tasks = queue.Queue()
+        self.replies = queue.Queue()
+        self.stop = threading.Event()
+        self.sockets = []
+        self.attempts = collections.Counter()
+        self.alive = len(parsed.workers)
+        for address in parsed.workers:
+            threading.Thread(target=self.slot, args=(address,),
+                    daemon=True).start()
+
+    def request(self, index):
+        name, definition, hart = self.todo[index]
+        return {
+                "module": harness.relative_to_harness(definition.source_file),
+                "argv": self.argv,
+                "test": name,
+                "class": definition.__name__,
+                "hart": hart.index if hart else None,
+                "repetition": repetition(self.todo, index),
+                "misa": [h.misa for h in self.target.harts]
+                }
+
+    def slot(self, address):
+        """Feed tasks to one worker connection until told to stop, or until
+        the worker goes away."""
+        index = None
+        try:
+            family, where = harness.parse_address(address)
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.settimeout(self.silence_timeout)
+            sock.connect(where)
+            self.sockets.append(sock)
+            reader = sock.makefile("rb")
+            while not self.stop.is_set():
+                try:
+                    index = self.tasks.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                harness.send_message(sock, self.request(index))
+                reply = harness.receive_message(reader)
+                while reply.get("heartbeat"):
+                    reply = harness.receive_message(reader)
+                self.replies.put((address, index, reply, None))
+                index = None
+        except (OSError, EOFError, ValueError) as e:
+            self.replies.put((address, index, None, e))
+
+    def run(self, indices, report):
+        """Run the tests at indices in self.todo. Return False if the run
+        should stop because of --fail-fast."""
+        outstanding = set(indices)
+        for index in indices:
+            self.tasks.put(index)
+        while outstanding:
+            if not self.alive:
+                print("No workers left.")
+                for index in sorted(outstanding):
+                    # There's nowhere left to retry them.
+                    report.add(self.todo[index][0], "exception", None, 0,
+                            retry=False)
+                return False
+            address, index, reply, error = self.replies.get()
+            if error is not None:
+                self.alive -= 1
+                print(f"Lost worker {address}: {error}")
+                if index is None:
+                    continue
+                self.attempts[index] += 1
+                if self.attempts[index] < self.max_attempts:
+                    print(f"[{self.todo[index][0]}] Re-queued")
+                    self.tasks.put(index)
+                    continue
+                result, log_name, elapsed = "exception", None, 0
+            else:
+                result, elapsed = reply["result"], reply["elapsed"]
+                log_name = test_log_name(self.parsed, self.target,
+                        self.todo[index][0])
+                with open(log_name, "w", encoding="utf-8") as fd:
+                    fd.write(reply["log"])
+                if self.todo[index][1] is ExamineTarget:
+                    for hart, misa in zip(self.target.harts, reply["misa"]):
+                        hart.misa = misa
+            result = report.add(self.todo[index][0], result, log_name,
+                    elapsed, iteration=repetition(self.todo, index))
+            if result is None:
+                self.tasks.put(index)
+                continue
+            outstanding.discard(index)
+            if result not in good_results and self.parsed.fail_fast:
+                return False
+        return True
+
+    def close(self):
+        self.stop.set()
+        for sock in self.sockets:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+def print_repeat_summary(runs):
+    """Print how often each test failed, and how long it took, over the
+    repetitions of a --repeat run."""
+    by_test = {}
+    for name, result, elapsed in runs:
+        by_test.setdefault(name, []).append((result, elapsed))
+    print(f"{'test':<36} {'runs':>5} {'failed':>6} {'min':>7} {'p50':>7} "
+            f"{'p95':>7} {'max':>7}")
+    for name, outcomes in sorted(by_test.items()):
+        failed = sum(result not in good_results for result, _ in outcomes)
+        elapsed = [e for _, e in outcomes]
+        print(f"{name:<36} {len(outcomes):5d} "
+                f"{100.0 * failed / len(outcomes):5.1f}% {min(elapsed):6.1f}s "
+                f"{history.percentile(elapsed, 0.5):6.1f}s "
+                f"{history.percentile(elapsed, 0.95):6.1f}s "
+                f"{max(elapsed):6.1f}s")
 
 def print_results(results):
     result = 0
@@ -983,12 +2375,17 @@ def print_results(results):
         print("%d tests returned %s" % (len(value), key))
         if key not in good_results:
             result = 1
+        if key not in good_results or key in ('flaky', 'quarantined',
+                'over_budget'):
             for name, log_name in value:
-                print("   %s > %s" % (name, log_name))
+                if log_name:
+                    print(f"   {name} > {log_name}")
+                else:
+                    print(f"   {name}")
 
     return result
 
-def add_test_run_options(parser):
+def add_test_run_options(parser, positional=True):
     parser.add_argument("--logs", default="logs",
             help="Store logs in the specified directory.")
     parser.add_argument("--fail-fast", "-f", action="store_true",
@@ -998,10 +2395,122 @@ def add_test_run_options(parser):
     parser.add_argument("--print-log-names", "--pln", action="store_true",
             help="Print names of temporary log files as soon as they are "
             "created.")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+            help="Run this many tests at the same time, each in its own "
+            "worker process. Implies --isolate.")
+    parser.add_argument("--fork", action="store_true",
+            help="Run every test in a worker process, even without --jobs, "
+            "so that a test that crashes or hangs can't take the harness down "
+            "with it.")
+    parser.add_argument("--threads", action="store_true",
+            help="With --jobs, run tests on threads in a single process "
+            "instead of on worker processes. This saves process startup time, "
+            "but a hung test can't be killed.")
+    parser.add_argument("--timeout", type=parse_timeout,
+            help="Kill any test that takes longer than this many seconds, "
+            "along with everything it started, and report it as a timeout. "
+            f"'auto' allows {Watchdog.factor} times as long as the test took "
+            f"in earlier runs (but at least {Watchdog.minimum}s). Defaults to "
+            "the target's test_timeout_sec. Not supported with --threads.")
+    parser.add_argument("--share-stacks", action="store_true",
+            help="Instead of starting a new simulator, server and gdb for "
+            "every test, let a test that passed leave them to the next one "
+            "if that compiles the same program and sets up the same way. The "
+            "target is reset between tests, and the program is only loaded "
+            "again if compare-sections finds it changed. Tests are reordered "
+            "so that such tests run one after the other. Not supported with "
+            "--threads or --workers.")
+    parser.add_argument("--compile-cache", metavar="DIR",
+            help="Keep compiled programs in DIR, and use them instead of "
+            "compiling again when the compiler, arguments, sources, headers "
+            "and link script are the same (see compilecache.py). Defaults to "
+            f"{compilecache.default_path()}. Use 'none' to always compile.")
+    parser.add_argument("--compile-cache-size", type=int, default=1024,
+            metavar="MB", help="Throw out the least recently used programs "
+            "when the compile cache gets bigger than this. Defaults to "
+            "%(default)s.")
+    parser.add_argument("--prefetch", choices=("compile", "stack"),
+            help="While a test runs, compile the program the next test "
+            "needs. With 'stack', also start the next test's simulator, "
+            "server and gdb, which only works with targets that can be "
+            "instantiated more than once. Only applies when tests run one at "
+            "a time in this process (not with --jobs, --fork or --timeout).")
+    parser.add_argument("--repeat", type=int, default=1, metavar="N",
+            help="Run every selected test N times, each on its own stack, and "
+            "summarize how often each one failed and how long it took. "
+            "Combine with --jobs to find rare failures quickly.")
+    parser.add_argument("--retries", type=int, default=0, metavar="K",
+            help="Run a test again, on a new stack, up to K times if it "
+            "results in an exception or timeout. A test that passes on a "
+            "retry is reported as flaky, which doesn't fail the run.")
+    parser.add_argument("--quarantine", type=float, metavar="RATE",
+            help="Tests whose flake rate in the history database is at least "
+            "RATE (0 to 1) still run, but are reported as quarantined "
+            "instead of failing the run. See './history.py flakes'.")
+    parser.add_argument("--order", choices=("name", "longest"), default="name",
+            help="Order in which to run tests. 'longest' starts the tests that "
+            "took longest in earlier runs (according to the logs in --logs) "
+            "first, which keeps parallel runs from waiting on one slow test at "
+            "the end.")
+    parser.add_argument("--failures-first", action="store_true",
+            help="Run tests that failed the last time they ran first.")
+    parser.add_argument("--history", default=None,
+            help="sqlite database to record results and timings in. Defaults "
+            "to <logs>.sqlite, next to the log directory. Use 'none' to not "
+            "record anything.")
+    parser.add_argument("--cache", action="store_true",
+            help="Don't run tests that passed before with the same inputs "
+            "(the test's source, programs it compiles, target files, and "
+            "the gcc/gdb/OpenOCD/simulator binaries), according to the "
+            "history database. Report them as cached-pass instead.")
+    parser.add_argument("--rerun", action="store_true",
+            help="With --cache, run every test anyway, but still record "
+            "their inputs for future runs.")
+    parser.add_argument("--preflight", action="store_true",
+            help="Before running any tests, find out which ones don't apply "
+            "to the target (skip_tests and early_applicable()), in parallel, "
+            "and report them as not_applicable without running them. "
+            "Verdicts are cached in the history database.")
+    parser.add_argument("--time-budget", type=float, metavar="SECONDS",
+            help="Only run as many tests as are expected (from the history "
+            "database) to finish in SECONDS, taking --jobs and --repeat into "
+            "account. Tests that failed last time are picked first, then "
+            "tests whose inputs changed since they last ran, then the "
+            "cheapest. The rest are reported as over_budget.")
+    parser.add_argument("--shard", type=parse_shard,
+            help="i/N: only run the i-th of N parts of the selected tests. "
+            "Without --shard-timings, parts have about the same number of "
+            "tests.")
+    parser.add_argument("--shard-timings",
+            help="JSON file written by './history.py timings'. With --shard, "
+            "balance parts by expected duration instead of test count. All "
+            "shards must be given the same file.")
+    parser.add_argument("--results",
+            help="Write all results to this JSON file when done. See "
+            "merge_results.py.")
+    parser.add_argument("--jsonl",
+            help="Append a JSON object describing each test to this file as "
+            "soon as it finishes.")
+    parser.add_argument("--junit",
+            help="Write results in JUnit XML format to this file, updating it "
+            "as each test finishes.")
+    parser.add_argument("--workers", nargs="+", metavar="ADDRESS",
+            help="Run tests on agents started with worker.py, at HOST:PORT or "
+            "unix:PATH, instead of locally. Each address runs one test at a "
+            "time; repeat it to run more. Workers run whatever commands and "
+            "files they are sent, so only use ones on trusted machines, "
+            "reached over a trusted network.")
+    parser.add_argument("--watch", action="store_true",
+            help="After running the selected tests, keep watching the files "
+            "they depend on (programs, the target's .py/.cfg/.lds files, and "
+            "the tests themselves), and run the affected tests again "
+            "whenever something changes.")
     parser.add_argument("--list-tests", action="store_true",
-            help="Print out a list of tests, and exit immediately.")
-    parser.add_argument("test", nargs='*',
-            help="Run only tests that are named here.")
+            help="Print out a list of tests, and exit immediately. "
+            "testlist.py lists them faster, but doesn't know about --shard.")
+    if positional:
+        parser.add_argument("test", nargs='*',
+                help="Run only tests that are named here.")
     parser.add_argument("--gcc",
             help="The command to use to start gcc.")
     parser.add_argument("--gdb",
@@ -1031,6 +2540,46 @@ def print_log(path):
 class BaseTest:
     # pylint: disable=too-many-instance-attributes
     compiled = {}
+    # Lock for each key in compiled, held while it's being compiled.
+    compiling = {}
+    # Maps test names to dicts of attributes. Each entry becomes a subclass
+    # with that name and those attributes, which is run and reported as a
+    # test of its own. The class that sets variants isn't run itself.
+    # Variants of the same class run one after the other, and use the same
+    # simulator/server/gdb stack if they can (see stack_key()), with or
+    # without --share-stacks.
+    variants = None
+    # In one of those subclasses, the class it was made from, and the
+    # attributes it was given.
+    variant_of = None
+    parameters = None
+    # The file the test is defined in, which workers (see worker.py) load to
+    # run it. That's not necessarily the module of the same name in
+    # sys.modules, eg. after daemon.py reloaded gdbserver.py.
+    source_file = None
+    # Tests that are only run when they're named in full on the command line,
+    # eg. because they take long and measure rather than check something.
+    opt_in = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # The module is in sys.modules while it's being executed.
+        cls.source_file = getattr(sys.modules.get(cls.__module__), "__file__",
+                None)
+        if not cls.__dict__.get('variants'):
+            return
+        # Put the variants in the module, so they're found like any other
+        # test.
+        module = sys.modules[cls.__module__]
+        for name, parameters in cls.variants.items():
+            attributes = dict(parameters)
+            attributes.update({
+                "__module__": cls.__module__,
+                "__qualname__": name,
+                "variants": None,
+                "variant_of": cls,
+                "parameters": parameters})
+            setattr(module, name, type(name, (cls,), attributes))
 
     def __init__(self, target, hart=None):
         self.target = target
@@ -1044,6 +2593,26 @@ class BaseTest:
         self.start = 0
         self.logs = []
         self.binaries = []
+        # Seconds spent in each phase of running the test.
+        self.phases = {}
+        # Where in Gdb.reset_delays to start. Repetitions of a test (see
+        # --repeat) start at different places.
+        self.reset_delay_start = 0
+        # With --share-stacks, use the stack of the previous test if it has
+        # the same stack_key(), and leave ours for the next one. Variants do
+        # that among themselves anyway (see Stack.usable_by()).
+        self.share_stack = False
+        # How much of each log previous tests on this stack already printed.
+        self.log_offsets = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Account the time spent in the with block to phase name."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.time() - start
 
     def early_applicable(self):
         """Return a false value if the test has determined it cannot run
@@ -1060,24 +2629,43 @@ class BaseTest:
     def setup(self):
         pass
 
+    def stack_key(self):
+        """Return a value that's equal for tests that can use the same
+        simulator/server/gdb stack one after the other, or None if this test
+        needs a stack of its own."""
+        return None
+
+    def reuse(self, stack):
+        """Take over stack from a previous test, and get it into the state
+        classSetup() would have left a new one in. Return False if that can't
+        be done, in which case the stack is shut down and classSetup() is
+        called instead."""
+        # pylint: disable=unused-argument
+        return False
+
+    def stack_intact(self):
+        """Return whether the test left its stack in a state that reuse() can
+        undo."""
+        return True
+
     def compile(self):
         compile_args = getattr(self, 'compile_args', None)
         self.binaries = []
         if compile_args:
             for hart in self.target.harts:
-                key = (compile_args, hart.misa)
-                if key not in BaseTest.compiled:
-                    BaseTest.compiled[key] = \
-                            self.target.compile(hart, *compile_args)
-                self.binaries.append(BaseTest.compiled.get(key))
+                self.binaries.append(compile_program(self.target, hart,
+                    compile_args))
 
     def classSetup(self):
-        self.compile()
-        self.target_process = self.target.create()
+        with self.phase("compile"):
+            self.compile()
+        with self.phase("target"):
+            self.target_process = self.target.create()
         if self.target_process:
             self.logs += self.target_process.lognames
         try:
-            self.server = self.target.server(self)
+            with self.phase("server"):
+                self.server = self.target.server(self)
             self.logs.append(self.server.logname)
         except Exception:
             for log in self.logs:
@@ -1108,11 +2696,16 @@ class BaseTest:
             return "not_applicable"
 
         self.start = time.time()
+        keep = False
 
         try:
-            self.classSetup()
-            self.setup()
-            result = self.test()    # pylint: disable=no-member
+            self.acquire_stack()
+            with self.phase("setup"):
+                self.setup()
+            with self.phase("test"):
+                result = self.test()    # pylint: disable=no-member
+            keep = (self.share_stack or self.variant_of is not None) and \
+                    not result and self.stack_intact()
         except TestNotApplicable:
             result = "not_applicable"
         except Exception as e: # pylint: disable=broad-except
@@ -1135,21 +2728,80 @@ class BaseTest:
             return result
 
         finally:
-            # Get handles to logs before the files are deleted.
-            logs = []
-            for log in self.logs:
-                logs.append((log, open(log, "r", errors='ignore')))
-
-            self.classTeardown()
-            for name, handle in logs:
-                print_log_handle(name, handle)
-            header("End of logs")
+            self.release_stack(keep)
 
         if not result:
             result = 'pass'
         return result
 
-gdb_cmd = None
+    def acquire_stack(self):
+        """Use the stack the previous test left behind, if this test can, or
+        start a new one."""
+        stack = session().take_stack(self.stack_key())
+        if stack and stack.usable_by(type(self), self.share_stack) and \
+                stack.key is not None and stack.key == self.stack_key():
+            if stack.output:
+                header("Prefetched")
+                sys.stdout.write(stack.output)
+            with self.phase("reset"):
+                if self.reuse(stack):
+                    return
+        # Shut the old stack down before starting another.
+        stack = None
+        self.classSetup()
+
+    def release_stack(self, keep):
+        """Print the test's logs, and leave its stack for the next test if
+        keep is true, or tear it down otherwise."""
+        # Get handles to logs before the files are deleted.
+        logs = []
+        for log in self.logs:
+            # pylint: disable=consider-using-with
+            handle = open(log, "r", encoding="utf-8", errors='ignore')
+            handle.seek(self.log_offsets.get(log, 0))
+            logs.append((log, handle))
+
+        stack = None
+        with self.phase("teardown"):
+            if keep and self.stack_key() is not None:
+                stack = Stack(self)
+                session().stack = stack
+            else:
+                self.classTeardown()
+        for name, handle in logs:
+            print_log_handle(name, handle)
+            if stack:
+                stack.offsets[name] = handle.tell()
+        header("End of logs")
+
+class Stack:
+    """The simulator, server and gdb of a test that passed, kept so that the
+    next test can use them if it has the same stack_key()."""
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, test):
+        self.key = test.stack_key()
+        self.hart = test.hart
+        self.variant_of = test.variant_of
+        self.target_process = test.target_process
+        self.server = test.server
+        self.gdb = getattr(test, 'gdb', None)
+        self.binaries = test.binaries
+        self.logs = test.logs
+        self.offsets = {}
+        # Whether the stack was started for the test by Prefetcher, and what
+        # was printed while it was.
+        self.prefetched = False
+        self.output = ""
+
+    def usable_by(self, definition, share_stacks):
+        """Return whether a test of class definition may use this stack, as
+        long as its stack_key() is the same: any test may with --share-stacks,
+        and otherwise only another variant of the same class, or the test the
+        stack was prefetched for."""
+        return share_stacks or self.prefetched or \
+                (self.variant_of is not None and
+                        self.variant_of is definition.variant_of)
+
 class GdbTest(BaseTest):
     def __init__(self, target, hart=None):
         BaseTest.__init__(self, target, hart=hart)
@@ -1164,20 +2816,69 @@ class GdbTest(BaseTest):
     def classSetup(self):
         BaseTest.classSetup(self)
 
-        self.gdb = Gdb(self.target, self.server.gdb_ports, cmd=gdb_cmd,
-                       timeout=self.target.timeout_sec, binaries=self.binaries)
+        with self.phase("gdb"):
+            self.gdb = Gdb(self.target, self.server.gdb_ports,
+                    cmd=session().gdb_cmd, timeout=self.target.timeout_sec,
+                    binaries=self.binaries)
+            self.gdb.reset_delay_index = self.reset_delay_start % \
+                    len(Gdb.reset_delays)
 
-        self.logs += self.gdb.lognames()
-        self.gdb.connect()
+            self.logs += self.gdb.lognames()
+            self.gdb.connect()
 
-        for cmd in self.target.gdb_setup:
-            self.gdb.command(cmd)
+            for cmd in self.target.gdb_setup:
+                self.gdb.command(cmd)
 
-        self.gdb.select_hart(self.hart)
+            self.gdb.select_hart(self.hart)
+            # Every test on this stack gets the setup above.
+            self.gdb.settle()
 
         # FIXME: OpenOCD doesn't handle PRIV now
         #self.gdb.p("$priv=3")
 
+    def stack_key(self):
+        cls = type(self)
+        if cls.classSetup not in (GdbTest.classSetup,
+                GdbSingleHartTest.classSetup) or \
+                cls.classTeardown is not GdbTest.classTeardown:
+            # reuse() doesn't know how to redo whatever else these do.
+            return None
+        return (id(self.target), self.hart.id,
+                getattr(self, 'compile_args', None), cls.classSetup,
+                self.freertos())
+
+    def reuse(self, stack):
+        self.target_process = stack.target_process
+        self.server = stack.server
+        self.gdb = stack.gdb
+        self.binaries = stack.binaries
+        self.logs = stack.logs
+        self.log_offsets = stack.offsets
+        self.gdb.reset_delay_index = self.reset_delay_start % \
+                len(Gdb.reset_delays)
+        self.gdb.loaded_before = self.gdb.loaded_before or self.gdb.loaded
+        self.gdb.loaded = False
+
+        # The previous test may have left harts running.
+        self.gdb.interrupt_all()
+        self.gdb.command("monitor reset halt", ops=20)
+        self.gdb.global_command("maintenance flush register-cache")
+        self.gdb.select_hart(self.hart)
+        return True
+
+    def stack_intact(self):
+        return not self.gdb.changed
+
+    def release_stack(self, keep):
+        if keep:
+            # Leave gdb the way the next test expects to find it.
+            try:
+                keep = self.gdb.restore()
+            except Exception:   # pylint: disable=broad-except
+                traceback.print_exc(file=sys.stdout)
+                keep = False
+        BaseTest.release_stack(self, keep)
+
     def postMortem(self):
         if not self.gdb:
             return
@@ -1218,6 +2919,12 @@ class GdbSingleHartTest(GdbTest):
         GdbTest.classSetup(self)
         self.parkOtherHarts()
 
+    def reuse(self, stack):
+        if not GdbTest.reuse(self, stack):
+            return False
+        self.parkOtherHarts()
+        return True
+
 class ExamineTarget(GdbTest):
     def test(self):
         for hart in self.target.harts:
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+"""List the tests in gdbserver.py without importing it, so that listing them
+doesn't have to load pexpect, testlib and the targets.
+
+    ./testlist.py
+    ./testlist.py --verbose Memory
+
+The file is parsed and its classes are inspected statically. A class is a
+test if it (or a class it derives from in the same file) has a test() method,
+just like gdbserver.py decides. Tests with opt_in set are only listed when
+they're named in full, as gdbserver.py only runs them then. The result is
+cached next to the file, and thrown away when the file changes."""
+
+import argparse
+import ast
+import json
+import os
+import sys
+
+# Bump when the format of the cache changes.
+CACHE_VERSION = 3
+
+class Scanner:
+    """Finds the tests among the classes defined at the top level of a
+    file."""
+    def __init__(self, tree):
+        self.classes = {}
+        for node in tree.body:
+            if isinstance(node, ast.ClassDef):
+                self.classes[node.name] = node
+
+    def mro(self, name, seen=None):
+        """Return name and the classes it derives from in this file, nearest
+        first. Classes imported from elsewhere (eg. GdbTest) don't define
+        test(), compile_args or early_applicable() in a way that matters
+        here, so they're left out."""
+        seen = seen or set()
+        if name not in self.classes or name in seen:
+            return []
+        seen.add(name)
+        result = [self.classes[name]]
+        for base in self.classes[name].bases:
+            if isinstance(base, ast.Name):
+                result += self.mro(base.id, seen)
+        return result
+
+    @staticmethod
+    def member(node, name):
+        """Return the statement in class node that defines name, or None."""
+        for statement in node.body:
+            if isinstance(statement, ast.FunctionDef) and \
+                    statement.name == name:
+                return statement
+            if isinstance(statement, ast.Assign):
+                for target in statement.targets:
+                    if isinstance(target, ast.Name) and target.id == name:
+                        return statement
+        return None
+
+    def lookup(self, classes, name):
+        """Return the class among classes that defines name first, and the
+        statement that defines it, or (None, None)."""
+        for node in classes:
+            statement = self.member(node, name)
+            if statement:
+                return node, statement
+        return None, None
+
+    @staticmethod
+    def compile_args(statement):
+        """Return compile_args as a list, or its source if it isn't a
+        literal."""
+        if not isinstance(statement, ast.Assign):
+            return None
+        try:
+            value = ast.literal_eval(statement.value)
+        except ValueError:
+            return ast.unparse(statement.value)
+        return list(value) if value else None
+
+    @staticmethod
+    def early_applicable(owner, statement):
+        """Return what early_applicable() returns, as source, or None if it
+        isn't overridden (and so always returns True)."""
+        if not isinstance(statement, ast.FunctionDef):
+            return None
+        body = [s for s in statement.body if not (isinstance(s, ast.Expr) and
+            isinstance(s.value, ast.Constant))]
+        if len(body) == 1 and isinstance(body[0], ast.Return) and \
+                body[0].value:
+            return ast.unparse(body[0].value)
+        return f"<{owner.name}.early_applicable()>"
+
+    @staticmethod
+    def opt_in(statement):
+        """Return whether statement sets opt_in to something true."""
+        if not isinstance(statement, ast.Assign):
+            return False
+        try:
+            return bool(ast.literal_eval(statement.value))
+        except ValueError:
+            return False
+
+    def variants(self, node):
+        """Return the names of the variants of node, or None. Only the names
+        have to be literals."""
+        statement = self.member(node, "variants")
+        if not isinstance(statement, ast.Assign) or \
+                not isinstance(statement.value, ast.Dict):
+            return None
+        return [key.value for key in statement.value.keys
+                if isinstance(key, ast.Constant)]
+
+    def tests(self):
+        """Return a list of dicts describing each test, sorted by name."""
+        tests = []
+        for name, node in self.classes.items():
+            classes = self.mro(name)
+            if not isinstance(self.lookup(classes, "test")[1],
+                    ast.FunctionDef):
+                continue
+            info = {
+                "class": name,
+                "compile_args": self.compile_args(
+                    self.lookup(classes, "compile_args")[1]),
+                "early_applicable": self.early_applicable(
+                    *self.lookup(classes, "early_applicable")),
+                "opt_in": self.opt_in(self.lookup(classes, "opt_in")[1])
+            }
+            variants = self.variants(node)
+            if variants:
+                for variant in variants:
+                    tests.append(dict(info, name=variant))
+            else:
+                tests.append(dict(info, name=name))
+        return sorted(tests, key=lambda test: test["name"])
+
+def cache_path(path):
+    directory, filename = os.path.split(os.path.abspath(path))
+    return os.path.join(directory, "__pycache__",
+            f"{os.path.splitext(filename)[0]}.tests.json")
+
+def list_tests(path):
+    """Return the tests in path, from the cache if path hasn't changed since
+    it was written."""
+    status = os.stat(path)
+    key = [CACHE_VERSION, status.st_mtime_ns, status.st_size]
+    cache = cache_path(path)
+    try:
+        with open(cache, encoding="utf-8") as fd:
+            cached = json.load(fd)
+        if cached["key"] == key:
+            return cached["tests"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    with open(path, encoding="utf-8") as fd:
+        tests = Scanner(ast.parse(fd.read(), path)).tests()
+    try:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        temporary = f"{cache}.{os.getpid()}"
+        with open(temporary, "w", encoding="utf-8") as fd:
+            json.dump({"key": key, "tests": tests}, fd)
+        os.replace(temporary, cache)
+    except OSError:
+        # Listing still works, it's just not cached.
+        pass
+    return tests
+
+def selected(test, names):
+    """Return whether test is selected by names, the way
+    testlib.select_tests() decides."""
+    if test["opt_in"]:
+        return test["name"] in names
+    return not names or any(name in test["name"] for name in names)
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="List tests without importing them.")
+    parser.add_argument("--file", default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "gdbserver.py"),
+        help="File to list the tests of (default: gdbserver.py).")
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument("--verbose", "-v", action="store_true",
+            help="Also print the sources each test compiles, and what "
+            "decides whether it applies to a target.")
+    output.add_argument("--json", action="store_true",
+            help="Print everything as JSON.")
+    parser.add_argument("test", nargs="*",
+            help="Only list tests whose name contains any of these.")
+    parsed = parser.parse_args()
+
+    tests = [test for test in list_tests(parsed.file) if selected(test,
+        parsed.test)]
+    if parsed.json:
+        json.dump(tests, sys.stdout, indent=2)
+        print()
+        return 0
+    for test in tests:
+        if parsed.verbose:
+            compile_args = test["compile_args"]
+            if isinstance(compile_args, list):
+                compile_args = " ".join(compile_args)
+            print(f"{test['name']:<40} {compile_args or '-':<40} "
+                    f"{test['early_applicable'] or '-'}")
+        else:
+            print(test["name"])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
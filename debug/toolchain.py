@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+"""Find out what the RISC-V compiler supports without failing a real compile
+first. Each question (eg. whether -march=rv64imafdcv works) is answered by
+compiling a tiny program once, and the answer is kept on disk under a hash of
+the gcc binary, what it says its version is, and the assembler it uses, so
+it's only asked again when the toolchain changes.
+
+    ./toolchain.py
+    ./toolchain.py --gcc $RISCV/bin/riscv64-unknown-elf-gcc
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+# Extensions Target.do_compile() adds to -march when the hart has them.
+LETTERS = "imafdcv"
+
+def default_path():
+    base = os.environ.get("XDG_CACHE_HOME") or \
+            os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "riscv-tests-debug", "toolchain")
+
+def hash_file(digest, path):
+    with open(path, "rb") as fd:
+        for block in iter(lambda: fd.read(1 << 20), b""):
+            digest.update(block)
+
+def mabi(xlen):
+    return "ilp32" if xlen == 32 else f"lp{xlen}"
+
+class Toolchain:
+    def __init__(self, gcc, directory=None):
+        self.gcc = gcc
+        self.answers = {}
+        self.path = None
+        found = shutil.which(gcc)
+        if found:
+            digest = hashlib.sha256()
+            hash_file(digest, found)
+            # The driver may stay the same when what it runs changes (eg. a
+            # newer binutils installed next to it).
+            for args in (["--version"], ["-print-prog-name=as"]):
+                try:
+                    output = subprocess.run([gcc] + args,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, check=False).stdout
+                except OSError:
+                    output = b""
+                digest.update(output)
+            assembler = shutil.which(output.decode(errors="replace").strip())
+            if assembler:
+                hash_file(digest, assembler)
+            self.path = os.path.join(directory or default_path(),
+                    f"{digest.hexdigest()}.json")
+            self.answers = self.load()
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        # Other processes may have added answers since we loaded ours.
+        answers = self.load()
+        answers.update(self.answers)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd, temporary = tempfile.mkstemp(dir=os.path.dirname(self.path))
+            with os.fdopen(fd, "w", encoding="utf-8") as out:
+                json.dump(answers, out, indent=2, sort_keys=True)
+            os.replace(temporary, self.path)
+        except OSError:
+            # Only means we'll have to ask again next time.
+            pass
+
+    def compiles(self, args, source="", language="c"):
+        """Return whether gcc can compile source (in language) with args, or
+        None if there is no gcc to ask (eg. when all programs come from an
+        imported compile cache)."""
+        key = " ".join(args + [language, source])
+        if key not in self.answers:
+            if not self.path:
+                return None
+            try:
+                process = subprocess.run([self.gcc] + args + ["-c", "-x",
+                    language, "-", "-o", os.devnull], input=source.encode(),
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                    check=False)
+                self.answers[key] = process.returncode == 0
+            except OSError:
+                self.answers[key] = False
+            self.save()
+        return self.answers[key]
+
+    def supports_march(self, march, abi):
+        return self.compiles([f"-march={march}", f"-mabi={abi}"])
+
+    def march_letters(self, xlen):
+        """Return the letters in LETTERS that gcc accepts in -march, each one
+        on top of rv<xlen>i (and F for D, which needs it)."""
+        letters = ""
+        for letter in LETTERS:
+            extra = {"i": "", "d": "fd", "v": "fdv"}.get(letter, letter)
+            if self.supports_march(f"rv{xlen}i{extra}", mabi(xlen)):
+                letters += letter
+        return letters
+
+    def vector_csrs(self, xlen):
+        """Return whether the assembler knows the vector CSRs."""
+        return self.compiles([f"-march=rv{xlen}imafdv", f"-mabi={mabi(xlen)}"],
+                "csrr a0, vlenb\n", "assembler-with-cpp")
+
+    def zfh(self, xlen):
+        """Return whether gcc accepts Zfh (half precision floating point)."""
+        return self.supports_march(f"rv{xlen}g_zfh", mabi(xlen))
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Show what the RISC-V compiler supports.")
+    parser.add_argument("--gcc", default="riscv64-unknown-elf-gcc",
+            help="The compiler to ask. Defaults to %(default)s.")
+    parsed = parser.parse_args()
+
+    toolchain = Toolchain(parsed.gcc)
+    if not toolchain.path:
+        print(f"Can't find {parsed.gcc}.")
+        return 1
+    print(f"Answers are kept in {toolchain.path}")
+    for xlen in (32, 64):
+        letters = toolchain.march_letters(xlen) or "-"
+        vector_csrs = "yes" if toolchain.vector_csrs(xlen) else "no"
+        zfh = "yes" if toolchain.zfh(xlen) else "no"
+        print(f"rv{xlen}: march letters {letters}, vector CSRs {vector_csrs}, "
+                f"Zfh {zfh}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+"""Run tests on behalf of gdbserver.py --workers, which may be on another
+machine. Each connection is handled by its own process, which runs one test at
+a time and sends the result and log back. The harness directory (and the
+programs and targets in it) must match the coordinator's.
+
+Whoever can connect to a worker can make it run any command (as sim_cmd,
+server_cmd or gdb) and any Python file (as a target or test module), as the
+user running it. So it only listens on 127.0.0.1 unless told otherwise, and
+its Unix sockets are only accessible to that user."""
+
+import argparse
+import os
+import shutil
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+
+import harness
+import targets
+import testlib
+
+class ForkingUnixStreamServer(socketserver.ForkingMixIn,
+        socketserver.UnixStreamServer):
+    pass
+
+class Handler(socketserver.StreamRequestHandler):
+    # Send a heartbeat this often while a test runs, so the coordinator can
+    # tell a slow test from a dead worker.
+    heartbeat_interval = 10
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.lock = threading.Lock()
+        self.logs = tempfile.mkdtemp(prefix="worker-")
+        self.targets = {}
+        self.modules = {}
+
+    def finish(self):
+        socketserver.StreamRequestHandler.finish(self)
+        shutil.rmtree(self.logs, ignore_errors=True)
+
+    def send(self, message):
+        with self.lock:
+            harness.send_message(self.request, message)
+
+    def handle(self):
+        while True:
+            try:
+                request = harness.receive_message(self.rfile)
+            except (EOFError, OSError):
+                return
+            self.send(self.run(request))
+
+    def target(self, argv):
+        """Return parsed options and the target for argv, instantiating each
+        target only once per connection."""
+        key = tuple(argv)
+        if key not in self.targets:
+            parser = argparse.ArgumentParser()
+            targets.add_target_options(parser)
+            testlib.add_test_run_options(parser)
+            parsed = parser.parse_args(argv + ["--logs", self.logs,
+                "--history", "none", "--isolate"])
+            self.targets[key] = (parsed, targets.target(parsed))
+        return self.targets[key]
+
+    def module(self, path):
+        """Return the module in path, reusing it if it's already imported
+        (eg. testlib itself)."""
+        path = os.path.realpath(path)
+        if path not in self.modules:
+            for module in list(sys.modules.values()):
+                filename = getattr(module, "__file__", None)
+                if filename and os.path.realpath(filename) == path:
+                    self.modules[path] = module
+                    break
+            else:
+                self.modules[path] = testlib.load_module(path)
+        return self.modules[path]
+
+    def run(self, request):
+        parsed, target = self.target(request["argv"])
+        definition = getattr(self.module(request["module"]), request["class"])
+        for hart, misa in zip(target.harts, request["misa"]):
+            hart.misa = misa
+        hart = None
+        if request["hart"] is not None:
+            hart = target.harts[request["hart"]]
+
+        done = threading.Event()
+        def heartbeat():
+            while not done.wait(self.heartbeat_interval):
+                self.send({"heartbeat": True})
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            with testlib.Session.from_parsed(parsed):
+                result, log_name, elapsed = testlib.run_test(parsed, target,
+                        request["test"], definition, hart,
+                        iteration=request.get("repetition", 0))
+        finally:
+            done.set()
+            thread.join()
+
+        with open(log_name, encoding="utf-8", errors="replace") as fd:
+            log = fd.read()
+        os.unlink(log_name)
+        return {
+                "result": result,
+                "elapsed": elapsed,
+                "log": log,
+                "misa": [h.misa for h in target.harts]
+                }
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Run tests for gdbserver.py --workers.")
+    parser.add_argument("--listen", default="127.0.0.1:0",
+            help="HOST:PORT or unix:PATH to accept connections on. Defaults "
+            "to %(default)s, a free port that only this machine can connect "
+            "to. Anyone who can connect can run any command as you, so only "
+            "listen on an address trusted machines alone can reach.")
+    parsed = parser.parse_args()
+
+    family, address = harness.parse_address(parsed.listen)
+    # Requests name files relative to the harness directory.
+    if family == socket.AF_UNIX:
+        address = os.path.abspath(address)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    if family == socket.AF_UNIX:
+        if os.path.exists(address):
+            os.unlink(address)
+        # Only accessible to us from the moment it exists.
+        umask = os.umask(0o077)
+        try:
+            server = ForkingUnixStreamServer(address, Handler)
+        finally:
+            os.umask(umask)
+        print(f"Listening on unix:{address}")
+    else:
+        socketserver.ForkingTCPServer.allow_reuse_address = True
+        server = socketserver.ForkingTCPServer(address, Handler)
+        host, port = server.server_address[:2]
+        print(f"Listening on {host}:{port}")
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())